@@ -594,8 +594,8 @@ install_website ()
 		echo -e ""$GREEN"Environment passed with '-E' switch"$RESET""
 	fi
 
-	declare -a ServiceFiles=("celery" "celery.service" "intvlm8r" "intvlm8r.service" "cameraTransfer.service" "setTime.service" "piTransfer.service" "heartbeat.service" "apt-daily.timer" "apt-daily.service" "myIp.service")
-	declare -a VenvFiles=("cameraTransfer.service" "setTime.service" "piTransfer.service" "heartbeat.service" ) # These? "apt-daily.timer" "apt-daily.service" "myIp.service" "celery.service"
+	declare -a ServiceFiles=("celery" "celery.service" "intvlm8r" "intvlm8r.service" "cameraTransfer.service" "cameraBroker.service" "setTime.service" "piTransfer.service" "heartbeat.service" "apt-daily.timer" "apt-daily.service" "myIp.service")
+	declare -a VenvFiles=("cameraTransfer.service" "cameraBroker.service" "setTime.service" "piTransfer.service" "heartbeat.service" ) # These? "apt-daily.timer" "apt-daily.service" "myIp.service" "celery.service"
 
   # Here's where you start to build the website. This process is largely a copy/mashup of these posts.[^3] [^4] [^5]
 	cd  ${HOME}
@@ -630,7 +630,12 @@ install_website ()
 
 	if [ -f piThumbsInfo.txt ];
 	then
-		mv -nv piThumbsInfo.txt ~/thumbs/piThumbsInfo.txt # -n = "do not overwrite"
+		if [ -f ~/thumbs/piThumbsInfo.db ];
+		then
+			rm -f piThumbsInfo.txt # Already imported into the .db. Putting it back would only be imported again
+		else
+			mv -nv piThumbsInfo.txt ~/thumbs/piThumbsInfo.txt # -n = "do not overwrite"
+		fi
 	fi
 
 	if [ -f piTransfer.log ];
@@ -801,6 +806,20 @@ install_website ()
 	echo -e ""$GREEN"Enabling cameraTransfer.service"$RESET""
 	systemctl enable cameraTransfer.service
 
+	#Camera Broker
+	if [ -f cameraBroker.service ];
+	then
+		if cmp -s cameraBroker.service /etc/systemd/system/cameraBroker.service;
+		then
+			echo "Skipped: the file '/etc/systemd/system/cameraBroker.service' already exists & the new version is unchanged"
+		else
+			mv -fv cameraBroker.service /etc/systemd/system/cameraBroker.service
+		fi
+	fi
+	chmod 644 /etc/systemd/system/cameraBroker.service
+	echo -e ""$GREEN"Enabling cameraBroker.service"$RESET""
+	systemctl enable cameraBroker.service
+
 	#Pi Transfer
 	if [ -f piTransfer.service ];
 	then
@@ -2257,7 +2276,7 @@ test_install ()
 	fi
 
 	matchRegex="\s*Names=([\.[:alnum:]-]*).*LoadState=(\w*).*ActiveState=(\w*).*SubState=(\w*).*" # Bash doesn't do digits as "\d"
-	serviceList="setTime cameraTransfer piTransfer heartbeat.timer apt-daily.timer apt-daily.service"
+	serviceList="setTime cameraTransfer cameraBroker piTransfer heartbeat.timer apt-daily.timer apt-daily.service"
 	if [[ $remoteit_version == 2 ]];
 	then
 		serviceList="remoteit-refresh.service ${serviceList}"
@@ -2274,6 +2293,10 @@ test_install ()
 		echo ''
 		echo -e "Service = $serviceName"
 		case "$serviceName" in
+			("cameraBroker.service")
+				[ $serviceLoadState == 'loaded' ]     && echo -e "  LoadState   = "$GREEN"$serviceLoadState"$RESET""   || echo -e "  LoadState   = "$YELLOW"$serviceLoadState"$RESET""
+				[ $serviceActiveState == 'active' ]   && echo -e "  ActiveState = "$GREEN"$serviceActiveState"$RESET"" || echo -e "  ActiveState = "$YELLOW"$serviceActiveState"$RESET""
+				;;
 			("heartbeat.timer")
 				[ $serviceLoadState == 'loaded' ]     && echo -e "  LoadState   = "$GREEN"$serviceLoadState"$RESET""   || echo -e "  LoadState   = "$YELLOW"$serviceLoadState"$RESET""
 				[ $serviceActiveState == 'active' ]   && echo -e "  ActiveState = "$GREEN"$serviceActiveState"$RESET"" || echo -e "  ActiveState = "$YELLOW"$serviceActiveState"$RESET""
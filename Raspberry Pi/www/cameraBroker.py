@@ -0,0 +1,393 @@
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+# This script is part of the Intervalometerator project, a time-lapse camera controller for DSLRs:
+# https://github.com/greiginsydney/Intervalometerator
+# https://greiginsydney.com/intvlm8r
+# https://intvlm8r.com
+#
+# This project incorporates code from python-gphoto2, and we are incredibly indebted to Jim Easterbrook for it.
+# python-gphoto2 - Python interface to libgphoto2 http://github.com/jim-easterbrook/python-gphoto2 Copyright (C) 2015-17 Jim
+# Easterbrook jim@jim-easterbrook.me.uk
+
+# The camera broker is the one process that talks to the camera over USB. The website (all of gunicorn's workers) and
+# Celery send it their requests over a local socket, and it handles them one at a time. The camera's session is held
+# open between requests, and its config is cached, so a page load doesn't pay for the camera's initialisation.
+# After IDLE_RELEASE seconds without a request the session is closed, so the camera can still power itself off.
+#
+# Each request is one line of JSON: {"op": "<name>", ...}. The reply is one line of JSON: {"ok": true|false, ...}.
+# If the reply has a "length", that many bytes of binary data (e.g. a preview image) follow it.
+#
+# copyNow needs the camera for longer, and for far more than these requests cover. It asks for a 'lease': the broker
+# closes its session & turns all requests away until the lease is returned (or expires), leaving the USB to copyNow.
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import time
+
+import gphoto2 as gp
+
+
+# ////////////////////////////////
+# /////////// STATICS ////////////
+# ////////////////////////////////
+
+PI_USER_HOME   = os.path.expanduser('~')
+BROKER_SOCKET  = os.path.join(PI_USER_HOME, 'www/cameraBroker.sock')
+LOGFILE_NAME   = os.path.join(PI_USER_HOME, 'cameraBroker.log')
+IDLE_RELEASE   = 60   # Close the camera's session after this many seconds without a request
+CONFIG_TTL     = 30   # Seconds the camera's config tree is reused before it's fetched again. Any write refreshes it
+LEASE_LIMIT    = 4200 # The longest a lease is honoured, in seconds, in case the holder dies without returning it
+LIVEVIEW_IDLE  = 10   # End the live view after this many seconds without a viewer asking for a frame
+CLIENT_TIMEOUT = 30   # How long a client waits for the broker's reply, in seconds
+
+camera = None
+context = None
+lastUsed = 0
+liveConfig = None   # The camera's config tree, as last fetched by getConfig()
+snapshot = None
+snapshotTime = 0
+leaseHolder = None
+leaseExpires = 0
+liveFrame = None    # The last live view frame, shared by all the viewers
+liveFrameTime = 0
+liveFrameSeq = 0    # Counts the frames captured, so a viewer can tell a new frame from one it's already sent
+liveViewLastAsked = 0
+
+
+def main(argv):
+    logging.basicConfig(filename=LOGFILE_NAME, filemode='a', format='{asctime} {message}', style='{', datefmt='%Y/%m/%d %H:%M:%S', level=logging.INFO)
+    log('cameraBroker started')
+    if os.path.exists(BROKER_SOCKET):
+        os.remove(BROKER_SOCKET) # Left over from the last run
+    with BrokerServer(BROKER_SOCKET, BrokerHandler) as server:
+        os.chmod(BROKER_SOCKET, 0o660) # The owner and www-data only
+        try:
+            server.serve_forever(poll_interval=1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            closeCamera()
+            log('cameraBroker stopped')
+
+
+class BrokerServer(socketserver.UnixStreamServer):
+    """
+    Deliberately not threaded: requests are handled one at a time, so no two of them can be talking to the camera
+    """
+    def service_actions(self):
+        # Called by serve_forever() between requests, and every poll_interval while we're idle
+        global leaseHolder
+        if camera is not None and time.time() - lastUsed > IDLE_RELEASE:
+            log(f'Idle for {IDLE_RELEASE}s. Releasing the camera')
+            closeCamera()
+        if liveFrame is not None and time.time() - liveViewLastAsked > LIVEVIEW_IDLE:
+            # Closing the session is the one sure way to end the live view (& lower the mirror) on every camera
+            log(f'No live view viewers for {LIVEVIEW_IDLE}s. Releasing the camera')
+            closeCamera()
+        if leaseHolder is not None and time.time() > leaseExpires:
+            log(f'The lease held by {leaseHolder} has expired')
+            leaseHolder = None
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    timeout = CLIENT_TIMEOUT
+
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline())
+        except Exception as e:
+            log(f'Bad request: {e}')
+            return
+        reply, data = dispatch(message)
+        if data is not None:
+            reply['length'] = len(data)
+        try:
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+            if data is not None:
+                self.wfile.write(data)
+        except Exception as e:
+            log(f'Failed to reply to {message.get("op")}: {e}')
+
+
+def dispatch(message):
+    """
+    Runs one request. Returns the reply (a dict) and any binary data to follow it
+    """
+    global lastUsed
+    op = message.get('op')
+    handler = OPERATIONS.get(op)
+    if handler is None:
+        return {'ok': False, 'error': f'Unknown op {op}'}, None
+    if leaseHolder is not None and op not in ('lease', 'unlease', 'status'):
+        return {'ok': False, 'error': 'leased', 'holder': leaseHolder}, None
+    try:
+        return handler(message)
+    except gp.GPhoto2Error as e:
+        log(f'{op}: GPhoto2Error: {e.string}')
+        closeCamera() # It's asleep, gone or confused. Start afresh next time
+        return {'ok': False, 'error': e.string}, None
+    except Exception as e:
+        log(f'{op}: error: {e}')
+        closeCamera()
+        return {'ok': False, 'error': str(e)}, None
+    finally:
+        if camera is not None:
+            lastUsed = time.time() # Only the camera's requests count. A 'status' shouldn't keep it awake
+
+
+def openCamera():
+    """
+    Returns the open session, or opens one. Raises GPhoto2Error if the camera's not there or asleep
+    ('Unknown model'), in which case it's up to the client to wake it and ask again
+    """
+    global camera, context, liveConfig, snapshot
+    if camera is None:
+        newCamera = gp.Camera()
+        newContext = gp.gp_context_new()
+        newCamera.init(newContext)
+        camera, context = newCamera, newContext
+        liveConfig = None
+        snapshot = None
+        log('Camera session opened')
+    return camera
+
+
+def closeCamera():
+    global camera, context, liveConfig, snapshot, liveFrame
+    if camera is not None:
+        try:
+            camera.exit()
+        except Exception as e:
+            log(f'closeCamera: {e}')
+        camera = None
+        context = None
+        liveConfig = None
+        snapshot = None
+        liveFrame = None
+        log('Camera session closed')
+
+
+def serialiseWidget(widget):
+    """
+    Turns the camera's config tree into plain dicts & lists that can be sent as JSON
+    """
+    widgetType = widget.get_type()
+    entry = {'name': widget.get_name(), 'label': widget.get_label(), 'type': widgetType, 'readonly': widget.get_readonly()}
+    if widgetType in (gp.GP_WIDGET_WINDOW, gp.GP_WIDGET_SECTION):
+        entry['children'] = [serialiseWidget(widget.get_child(i)) for i in range(widget.count_children())]
+        return entry
+    try:
+        entry['value'] = widget.get_value()
+    except Exception:
+        entry['value'] = None
+    if widgetType in (gp.GP_WIDGET_RADIO, gp.GP_WIDGET_MENU):
+        entry['choices'] = [widget.get_choice(i) for i in range(widget.count_choices())]
+    elif widgetType == gp.GP_WIDGET_RANGE:
+        entry['range'] = list(widget.get_range())
+    return entry
+
+
+def getConfig(refresh=False):
+    """
+    The camera's config tree. It's a full PTP fetch, so it's only done once per CONFIG_TTL: the snapshot, 'set' and
+    'preview' all share it. 'refresh' forces a fresh fetch (e.g. after a write, to pick up what the camera made of it)
+    """
+    global liveConfig, snapshot, snapshotTime
+    openCamera()
+    if liveConfig is None or refresh or time.time() - snapshotTime > CONFIG_TTL:
+        liveConfig = camera.get_config(context)
+        snapshot = None
+        snapshotTime = time.time()
+    return liveConfig
+
+
+def opSnapshot(message):
+    """
+    The camera's model & config tree, from getConfig()
+    """
+    global snapshot
+    config = getConfig(message.get('refresh'))
+    if snapshot is None:
+        snapshot = {
+            'model'  : camera.get_abilities().model,
+            'config' : serialiseWidget(config)
+        }
+    return {'ok': True, 'snapshot': snapshot}, None
+
+
+def opSet(message):
+    """
+    Writes all of the 'settings' ({name: value}) to the camera in one set_config, and returns the fresh snapshot
+    """
+    settings = message.get('settings', {})
+    config = getConfig()
+    for name, value in settings.items():
+        OK, widget = gp.gp_widget_get_child_by_name(config, name)
+        if OK < gp.GP_OK:
+            log(f'set: the camera has no {name} setting')
+            continue
+        widgetType = widget.get_type()
+        if widgetType in (gp.GP_WIDGET_TOGGLE, gp.GP_WIDGET_DATE):
+            value = int(value)
+        elif widgetType == gp.GP_WIDGET_RANGE:
+            value = float(value)
+        else:
+            value = str(value)
+        widget.set_value(value)
+    if settings:
+        camera.set_config(config, context)
+        log(f'set: {", ".join(settings)}')
+    return opSnapshot({'refresh': bool(settings)})
+
+
+def opFiles(message):
+    """
+    What the home page needs to know about the images on the camera. Never cached: the camera could be shooting
+    """
+    openCamera()
+    storage = len(gp.check_result(gp.gp_camera_get_storageinfo(camera)))
+    files = listCameraFiles('/')
+    lastImage = None
+    if files:
+        folder, name = os.path.split(files[-1])
+        lastImage = gp.check_result(gp.gp_camera_file_get_info(camera, folder, name)).file.mtime
+    return {'ok': True, 'storage': storage, 'count': len(files), 'lastImage': lastImage}, None
+
+
+def listCameraFiles(path):
+    result = []
+    for name, value in gp.check_result(gp.gp_camera_folder_list_files(camera, path)):
+        result.append(os.path.join(path, name))
+    for name, value in gp.check_result(gp.gp_camera_folder_list_folders(camera, path)):
+        result.extend(listCameraFiles(os.path.join(path, name)))
+    return result
+
+
+def opPreview(message):
+    """
+    Straight out of Jim's examples. Returns the preview as JPEG data, which follows the reply
+    """
+    config = getConfig()
+    OK, image_format = gp.gp_widget_get_child_by_name(config, 'imageformat')
+    if OK >= gp.GP_OK:
+        # make sure it's not raw
+        if 'raw' in gp.check_result(gp.gp_widget_get_value(image_format)).lower():
+            return {'ok': False, 'error': 'Cannot preview raw images'}, None
+    # need to set this on a Canon 350d to get preview to work at all
+    OK, capture_size_class = gp.gp_widget_get_child_by_name(config, 'capturesizeclass')
+    if OK >= gp.GP_OK:
+        value = gp.check_result(gp.gp_widget_get_choice(capture_size_class, 2))
+        gp.check_result(gp.gp_widget_set_value(capture_size_class, value))
+        gp.check_result(gp.gp_camera_set_config(camera, config))
+    camera_file = gp.check_result(gp.gp_camera_capture_preview(camera))
+    file_data = gp.check_result(gp.gp_file_get_data_and_size(camera_file))
+    return {'ok': True}, bytes(memoryview(file_data))
+
+
+def opFrame(message):
+    """
+    One live view frame: the JPEG straight from the camera's preview buffer, which follows the reply.
+    Every viewer shares the one producer: a frame younger than 'maxAge' seconds is sent again rather than a new one
+    captured, so however many are watching, the camera's never asked for frames faster than the cap.
+    The reply's 'seq' numbers the frame, so each viewer only sends on the ones it hasn't already
+    """
+    global liveFrame, liveFrameTime, liveFrameSeq, liveViewLastAsked
+    openCamera()
+    liveViewLastAsked = time.time()
+    if liveFrame is None or time.time() - liveFrameTime >= float(message.get('maxAge', 0)):
+        camera_file = gp.check_result(gp.gp_camera_capture_preview(camera))
+        file_data = gp.check_result(gp.gp_file_get_data_and_size(camera_file))
+        liveFrame = bytes(memoryview(file_data))
+        liveFrameTime = time.time()
+        liveFrameSeq += 1
+    return {'ok': True, 'seq': liveFrameSeq}, liveFrame
+
+
+def opLease(message):
+    """
+    Hands the camera to the caller (e.g. copyNow) for up to 'seconds'. Everyone else is turned away until it's returned
+    """
+    global leaseHolder, leaseExpires
+    holder = message.get('holder', 'unknown')
+    if leaseHolder is not None and leaseHolder != holder:
+        return {'ok': False, 'error': 'leased', 'holder': leaseHolder}, None
+    closeCamera()
+    leaseHolder = holder
+    leaseExpires = time.time() + min(int(message.get('seconds', LEASE_LIMIT)), LEASE_LIMIT)
+    log(f'Camera leased to {holder}')
+    return {'ok': True}, None
+
+
+def opUnlease(message):
+    global leaseHolder
+    if leaseHolder is not None:
+        log(f'Camera returned by {leaseHolder}')
+    leaseHolder = None
+    return {'ok': True}, None
+
+
+def opRelease(message):
+    closeCamera()
+    return {'ok': True}, None
+
+
+def opStatus(message):
+    return {'ok': True, 'connected': camera is not None, 'leased': leaseHolder}, None
+
+
+OPERATIONS = {
+    'snapshot' : opSnapshot,
+    'set'      : opSet,
+    'files'    : opFiles,
+    'preview'  : opPreview,
+    'frame'    : opFrame,
+    'lease'    : opLease,
+    'unlease'  : opUnlease,
+    'release'  : opRelease,
+    'status'   : opStatus
+}
+
+
+def request(op, timeout=CLIENT_TIMEOUT, **args):
+    """
+    The client's end. Sends one request to the broker and returns its reply & any data that followed it.
+    If the broker isn't running the reply is {'ok': False, 'error': 'unavailable'}
+    """
+    message = dict(args, op=op)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(BROKER_SOCKET)
+            client.sendall((json.dumps(message) + '\n').encode('utf-8'))
+            with client.makefile('rb') as replies:
+                reply = json.loads(replies.readline())
+                data = None
+                if reply.get('length'):
+                    data = replies.read(reply['length'])
+        return reply, data
+    except (FileNotFoundError, ConnectionRefusedError):
+        return {'ok': False, 'error': 'unavailable'}, None
+    except Exception as e:
+        return {'ok': False, 'error': f'unavailable: {e}'}, None
+
+
+def log(message):
+    try:
+        logging.info(message)
+    except Exception as e:
+        print(f'error: {e}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -24,15 +24,21 @@
 
 
 import datetime
-from ftplib import FTP
+from ftplib import FTP, error_perm
 import configparser # for the ini file
 import fileinput
+import hashlib # The photo manifest
+import io
+import json
 import logging
 import os
+import queue # Upload workers
 import re    #RegEx
 import socket
+import sqlite3 # The upload ledger
 import subprocess
 import sys
+import threading
 import time
 
 #Only attempt to import these if they've been installed:
@@ -56,7 +62,12 @@ try:
     from apiclient import discovery
     from oauth2client import client
     from oauth2client.file import Storage
-    from googleapiclient.http import MediaFileUpload
+    from googleapiclient.errors import HttpError
+    from googleapiclient.http import MediaIoBaseUpload
+except:
+    pass
+try:
+    from PIL import Image # derivativeMode
 except:
     pass
 
@@ -72,22 +83,68 @@ else:
 
 PI_PHOTO_DIR  = os.path.join(PI_USER_HOME, 'photos')
 PI_THUMBS_DIR = os.path.join(PI_USER_HOME, 'thumbs')
-PI_THUMBS_INFO_FILE  = os.path.join(PI_THUMBS_DIR, 'piThumbsInfo.txt')
+PI_THUMBS_INFO_FILE  = os.path.join(PI_THUMBS_DIR, 'piThumbsInfo.txt') # Legacy. intvlm8r imports it once into PI_THUMBS_INFO_DB
+PI_THUMBS_INFO_DB    = os.path.join(PI_THUMBS_DIR, 'piThumbsInfo.db')
 PI_PREVIEW_DIR = os.path.join(PI_USER_HOME, 'preview')
-UPLOADED_PHOTOS_LIST = os.path.join(PI_PHOTO_DIR, 'uploadedOK.txt')
+PI_DERIVATIVE_DIR = os.path.join(PI_USER_HOME, 'derivatives') # derivativeMode's low-res copies are made here, and deleted once they're uploaded
+UPLOADED_PHOTOS_LIST = os.path.join(PI_PHOTO_DIR, 'uploadedOK.txt') # Legacy. Imported once into UPLOADED_PHOTOS_DB
+UPLOADED_PHOTOS_DB   = os.path.join(PI_USER_HOME, 'www/uploadedOK.db')
+PI_PHOTO_MANIFEST_DB = os.path.join(PI_USER_HOME, 'www/piPhotoManifest.db') # intvlm8r adds each image's hash as it's copied off the camera
+REMOTE_MANIFEST_NAME = 'piManifest.txt' # Each remote folder's manifest of what's been uploaded to it
+TRANSFER_METRICS_DB  = os.path.join(PI_USER_HOME, 'www/piTransferMetrics.db') # intvlm8r reads this for the /transfer page
 INIFILE_DIR          = os.path.join(PI_USER_HOME, 'www')
 INIFILE_NAME         = os.path.join(INIFILE_DIR, 'intvlm8r.ini')
 LOGFILE_DIR          = os.path.join(PI_USER_HOME, 'www/static')
 LOGFILE_NAME         = os.path.join(LOGFILE_DIR, 'piTransfer.log')
 KNOWN_HOSTS_FILE     = os.path.join(PI_USER_HOME, '.ssh/known_hosts')
 GOOGLE_CREDENTIALS   = os.path.join(PI_USER_HOME , 'www/Google_credentials.txt')
+GOOGLE_FOLDERS_CACHE = os.path.join(PI_USER_HOME , 'www/Google_folders.json')
 DROPBOX_TOKEN        = os.path.join(PI_USER_HOME , 'www/Dropbox_token.txt')
 RSYNC_LOG_FILE       = os.path.join(PI_USER_HOME , 'www/rsynclog.log')
-RSYNC_TMP_FILE       = os.path.join(PI_USER_HOME , 'www/rsynclog.tmp')
+RSYNC_FILES_LIST     = os.path.join(PI_USER_HOME , 'www/rsyncfiles.txt') # The --files-from list
+RSYNC_LOG_MAX        = 2**20 # Bytes. Once it's been fully read, the rsync log is emptied if it's grown bigger than this
 
 # Paramiko client configuration
 sftpPort = 22
 
+FTP_BLOCKSIZE = 65536   # Bytes per storbinary write
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024 # Dropbox & Google upload in chunks of this size. (Google requires a multiple of 256K)
+DBX_BATCH_SIZE = 100    # Dropbox upload sessions are committed in batches of up to this many files (the API's limit is 1000)
+MAX_CONCURRENCY = 8     # The most upload workers we'll run, regardless of what's in the INI file
+FANOUT_CACHE_BYTES = 64 * 2**20 # alsoTransferTo: the most image data held in memory for the destinations still to send it
+TRANSFER_MARGIN = 120   # Seconds. Uploads stop this long before the wakePi window closes
+
+# The ledger is committed after this many uploads, and again when the run ends. The same goes for deleteAfterTransfer deletions:
+LEDGER_COMMIT_EVERY = 25
+METRICS_KEEP_RUNS = 500 # The metrics of older runs (and their files) are pruned
+
+ledger = None
+ledgerUncommitted = 0
+ledgerLock = threading.Lock() # The upload workers share the one ledger connection
+uploadOrder = 'oldest'        # Or 'newest'. The order of files within each folder, and of the folders themselves
+transferDeadline = None       # When uploads have to stop (as a time.time() value), or None
+transferByteBudget = None     # The most this run can upload, or None
+heldOver = 0                  # Files that didn't fit in the budget & are left for the next run
+bytesUploaded = 0
+pendingDeletions = []         # deleteAfterTransfer: images uploaded since the last flushDeletions()
+manifestFolders = {}          # Per destination, the remote folders whose manifests need to be rewritten at the end of the run
+destinations = []             # tfrMethod, then any alsoTransferTo destinations. They're uploaded to concurrently
+destinationStatus = {}        # The last STATUS of each destination, when there's more than one
+current = threading.local()   # .destination is the destination the thread is uploading to
+legacyDestination = None      # tfrMethod when UPLOADED_PHOTOS_LIST was imported. Its '*' entries only count for that destination
+imagesScanned = False         # scanImages() only needs to run once, however many destinations there are
+fanOutCache = {}              # Image path: the bytes read by the first destination to send it, for the others
+fanOutWaiting = {}            # Image path: the destinations that have still to send it
+fanOutBytes = 0
+fanOutLock = threading.Lock()
+deletionLock = threading.Lock()
+uploadTier = 'original'       # Or 'derivative' while derivativeMode is sending the low-res copies
+derivativeLongEdge = 1600     # Pixels
+derivativeQuality = 70        # JPEG quality, 1-95
+metricsRun = None             # This run's row in TRANSFER_METRICS_DB
+metricsFiles = []             # (path, backend, bytes, duration, retries, error) for every file attempted this run
+lastStatus = ''
+
 
 def main(argv):
     logging.basicConfig(filename=LOGFILE_NAME, filemode='a', format='{asctime} {message}', style='{', datefmt='%Y/%m/%d %H:%M:%S', level=logging.DEBUG)
@@ -108,6 +165,9 @@ def main(argv):
                 return 0
 
     global deleteAfterTransfer  #Made global instead of passing this down from here to all the nested functions.
+    global uploadOrder
+    global uploadTier, derivativeLongEdge, derivativeQuality
+    global destinations
 
     if not os.path.isfile(INIFILE_NAME):
         log("STATUS: Upload aborted. I've lost the INI file")
@@ -132,7 +192,17 @@ def main(argv):
         'transferHour'       : '',
         'transferOnBootup'   : False,
         'deleteAfterTransfer': False,
-        'wakePiHour'         : '25'
+        'concurrency'        : '1',
+        'uploadOrder'        : 'oldest',
+        'transferBandwidth'  : '0',
+        'hourlyLimitMB'      : '0',
+        'derivativeMode'     : False,
+        'derivativeLongEdge' : '1600',
+        'derivativeQuality'  : '70',
+        'derivativeFolder'   : 'lowres',
+        'alsoTransferTo'     : '',
+        'wakePiHour'         : '25',
+        'wakePiDuration'     : ''
         })
     config.read(INIFILE_NAME)
     try:
@@ -154,7 +224,17 @@ def main(argv):
         transferHour        = config.get('Transfer', 'transferHour')
         transferOnBootup    = config.getboolean('Transfer', 'transferOnBootup')
         deleteAfterTransfer = config.getboolean('Transfer', 'deleteAfterTransfer')
+        concurrency         = max(1, min(config.getint('Transfer', 'concurrency'), MAX_CONCURRENCY))
+        uploadOrder         = config.get('Transfer', 'uploadOrder').lower()
+        transferBandwidth   = config.getint('Transfer', 'transferBandwidth')
+        hourlyLimitMB       = config.getint('Transfer', 'hourlyLimitMB')
+        derivativeMode      = config.getboolean('Transfer', 'derivativeMode')
+        derivativeLongEdge  = max(160, config.getint('Transfer', 'derivativeLongEdge'))
+        derivativeQuality   = max(1, min(config.getint('Transfer', 'derivativeQuality'), 95))
+        derivativeFolder    = config.get('Transfer', 'derivativeFolder').strip('/\\') or 'lowres'
+        alsoTransferTo      = config.get('Transfer', 'alsoTransferTo')
         wakePiHour          = config.get('Global', 'wakePiHour')
+        wakePiDuration      = config.get('Global', 'wakePiDuration')
 
     except Exception as e:
         tfrMethod = 'Off' # If we hit an unknown exception, force tfrMethod=Off, because we can't be sure what triggered the error
@@ -191,59 +271,544 @@ def main(argv):
         log('STATUS: Upload aborted. tfrMethod=Off')
         return
 
-    log(f'STATUS: Commencing upload using {tfrMethod}')
-    if (tfrMethod == 'FTP'):
+    destinations = [tfrMethod]
+    for destination in alsoTransferTo.split(','):
+        destination = destination.strip()
+        if destination in ('', 'Off') or destination in destinations:
+            continue
+        if destination not in ('FTP', 'SFTP', 'Dropbox', 'Google Drive', 'rsync'):
+            log(f"alsoTransferTo: unknown destination '{destination}' ignored")
+            continue
+        destinations.append(destination)
+
+    if not openLedger():
+        log('STATUS: Upload aborted. Unable to open the upload ledger')
+        return
+
+    log(f'STATUS: Commencing upload using {" + ".join(destinations)}')
+    uploadStarted = time.time()
+    openMetrics(' + '.join(destinations), uploadStarted)
+    try:
+        setTransferBudget(wakePiHour, wakePiDuration, transferBandwidth, hourlyLimitMB)
         while '\\' in ftpRemoteFolder:
             ftpRemoteFolder = ftpRemoteFolder.replace('\\', '/') # Escaping means the '\\' here is seen as a single backslash
         while '//' in ftpRemoteFolder:
             ftpRemoteFolder = ftpRemoteFolder.replace('//', '/')
-        log(f'ftpServer={ftpServer}, ftpUser={ftpUser}, ftpPassword=<redacted>, ftpRemoteFolder={ftpRemoteFolder}')
-        commenceFtp(ftpServer, ftpUser, ftpPassword, ftpRemoteFolder)
-    elif (tfrMethod == 'SFTP'):
         while '\\' in sftpRemoteFolder:
             sftpRemoteFolder = sftpRemoteFolder.replace('\\', '/') # Escaping means the '\\' here is seen as a single backslash
         while '//' in sftpRemoteFolder:
             sftpRemoteFolder = sftpRemoteFolder.replace('//', '/')
-        log(f'sftpServer={sftpServer}, sftpUser={sftpUser}, sftpPassword=<redacted>, sftpRemoteFolder={sftpRemoteFolder}')
-        commenceSftp(sftpServer, sftpUser, sftpPassword, sftpRemoteFolder)
-    elif (tfrMethod == 'Dropbox'):
-        commenceDbx(dbx_app_key)
-    elif (tfrMethod == 'Google Drive'):
         while '\\' in googleRemoteFolder:
             googleRemoteFolder = googleRemoteFolder.replace('\\', '/') # Escaping means the '\\' here is seen as a single backslash
         while '//' in googleRemoteFolder:
             googleRemoteFolder = googleRemoteFolder.replace('//', '/')
-        commenceGoogle(googleRemoteFolder)
-    elif (tfrMethod == 'rsync'):
         while '\\' in rsyncRemoteFolder:
             rsyncRemoteFolder = rsyncRemoteFolder.replace('\\', '/') # Escaping means the '\\' here is seen as a single backslash
         while '//' in rsyncRemoteFolder:
             rsyncRemoteFolder = rsyncRemoteFolder.replace('//', '/')
-        log(f'rsyncUsername={rsyncUsername}, rsyncHost={rsyncHost}, rsyncRemoteFolder={rsyncRemoteFolder}')
-        commenceRsync(rsyncUsername, rsyncHost, rsyncRemoteFolder)
-
-
-def list_New_Images(imagesPath, previouslyUploadedFile):
-    currentlist = []
-    lastlist = []
-    newFiles = []
-    for root, dirs, files in os.walk(os.path.expanduser(imagesPath)):
-        for name in files:
-            if '.thumbs' in dirs:
-                dirs.remove('.thumbs')
-            if name in ('.directory',):
+
+        def commence(method):
+            if (method == 'FTP'):
+                log(f'ftpServer={ftpServer}, ftpUser={ftpUser}, ftpPassword=<redacted>, ftpRemoteFolder={ftpRemoteFolder}, concurrency={concurrency}')
+                commenceFtp(ftpServer, ftpUser, ftpPassword, tierFolder(ftpRemoteFolder, derivativeFolder), concurrency)
+            elif (method == 'SFTP'):
+                log(f'sftpServer={sftpServer}, sftpUser={sftpUser}, sftpPassword=<redacted>, sftpRemoteFolder={sftpRemoteFolder}, concurrency={concurrency}')
+                commenceSftp(sftpServer, sftpUser, sftpPassword, tierFolder(sftpRemoteFolder, derivativeFolder), concurrency)
+            elif (method == 'Dropbox'):
+                commenceDbx(dbx_app_key, tierFolder('', derivativeFolder))
+            elif (method == 'Google Drive'):
+                commenceGoogle(tierFolder(googleRemoteFolder, derivativeFolder))
+            elif (method == 'rsync'):
+                log(f'rsyncUsername={rsyncUsername}, rsyncHost={rsyncHost}, rsyncRemoteFolder={rsyncRemoteFolder}')
+                commenceRsync(rsyncUsername, rsyncHost, rsyncRemoteFolder)
+
+        tiers = ['original']
+        if derivativeMode:
+            if destinations == ['rsync']:
+                log('derivativeMode is not available with rsync. Only the originals will be uploaded')
+            elif 'Image' not in globals():
+                log('derivativeMode needs PIL, which is not installed. Only the originals will be uploaded')
+            else:
+                tiers.insert(0, 'derivative')
+        for uploadTier in tiers:
+            tierDestinations = destinations
+            if uploadTier == 'derivative':
+                log(f"Uploading low-res copies ({derivativeLongEdge}px, quality {derivativeQuality}) to the '{derivativeFolder}' folder ahead of the originals")
+                tierDestinations = [destination for destination in destinations if destination != 'rsync'] # rsync only sends the originals
+            if len(destinations) == 1:
+                commence(tfrMethod)
+            else:
+                replicate(tierDestinations, commence)
+    finally:
+        recordThroughput(bytesUploaded, time.time() - uploadStarted)
+        closeLedger()
+        closeMetrics()
+
+
+def replicate(tierDestinations, commence):
+    """
+    alsoTransferTo: uploads to all the destinations at once, each in its own thread. Every destination has its own
+    session(s), remote folders & entries in the ledger, but they share the link, the deadline & the byte budget.
+    The run's closing STATUS gathers up each destination's last one
+    """
+    destinationStatus.clear()
+    threads = [threading.Thread(target=replicateTo, args=(destination, commence), daemon=True) for destination in tierDestinations]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log('STATUS: ' + '. '.join(f'{destination}: {destinationStatus.get(destination, "No result")}' for destination in tierDestinations))
+
+
+def replicateTo(destination, commence):
+    current.destination = destination
+    try:
+        commence(destination)
+    except Exception as e:
+        log(f'STATUS: Unexpected error: {e}')
+    finally:
+        releaseFanOut(destination)
+        current.destination = None
+
+
+def setTransferBudget(wakePiHour, wakePiDuration, transferBandwidth, hourlyLimitMB):
+    """
+    Works out how long we have, and how much we can send in that time.
+    If we're inside the Arduino's daily wakePi window, uploads have to stop TRANSFER_MARGIN seconds before it closes.
+    That time is converted to bytes by the configured transferBandwidth (KB/s), or the speed we measured last time.
+    An hourlyLimitMB caps the bytes sent in any hour, whatever the time of day.
+    """
+    global transferDeadline, transferByteBudget
+    if wakePiHour != '25' and not wakePiDuration:
+        # intvlm8r saves it when the Arduino's wakePi settings are read or changed. Until then, there's no deadline:
+        log(f'setTransferBudget: wakePiHour is {wakePiHour} but wakePiDuration is not in the INI file. Uploads will not stop before the Pi shuts down')
+    elif wakePiHour != '25':
+        try:
+            now = datetime.datetime.now()
+            for daysAgo in (0, 1):  # A window that opened late last night could still be open
+                windowStart = (now - datetime.timedelta(days=daysAgo)).replace(hour=int(wakePiHour), minute=0, second=0, microsecond=0)
+                windowEnd = windowStart + datetime.timedelta(minutes=int(wakePiDuration))
+                if windowStart <= now < windowEnd:
+                    transferDeadline = windowEnd.timestamp() - TRANSFER_MARGIN
+                    log(f'The Pi shuts down at {windowEnd.strftime("%H:%M")}. Uploads will stop by {datetime.datetime.fromtimestamp(transferDeadline).strftime("%H:%M:%S")}')
+                    break
+        except ValueError as e:
+            log(f'setTransferBudget: bad wakePi values {wakePiHour}/{wakePiDuration}: {e}')
+    if transferDeadline is not None:
+        bandwidth = transferBandwidth * 1024
+        if bandwidth <= 0:
+            measured = ledger.execute("SELECT value FROM meta WHERE key = 'throughput'").fetchone()
+            bandwidth = float(measured[0]) if measured else 0
+        if bandwidth > 0:
+            transferByteBudget = int(max(0, transferDeadline - time.time()) * bandwidth)
+            log(f'At {formatThroughput(bandwidth, 1)} there is time to upload {transferByteBudget // 2**20} MB')
+    if hourlyLimitMB > 0:
+        sentLastHour = ledger.execute('SELECT SUM(size) FROM uploads WHERE uploaded > ?', (time.time() - 3600,)).fetchone()[0] or 0
+        allowance = max(0, hourlyLimitMB * 2**20 - sentLastHour)
+        log(f'{sentLastHour // 2**20} MB uploaded in the last hour. {allowance // 2**20} MB of the {hourlyLimitMB} MB hourly limit remains')
+        if transferByteBudget is None or allowance < transferByteBudget:
+            transferByteBudget = allowance
+
+
+def openMetrics(backend, started):
+    """
+    Starts this run's entry in the metrics store. The per-file detail is held in metricsFiles until the run ends
+    """
+    global metricsRun
+    try:
+        isNew = not os.path.isfile(TRANSFER_METRICS_DB)
+        metrics = sqlite3.connect(TRANSFER_METRICS_DB, timeout=30)
+        with metrics:
+            metrics.executescript("""
+                CREATE TABLE IF NOT EXISTS runs  (id INTEGER PRIMARY KEY, started REAL, finished REAL, backend TEXT, files INTEGER, filesOK INTEGER,
+                                                  bytes INTEGER, retries INTEGER, errors INTEGER, heldOver INTEGER, status TEXT);
+                CREATE TABLE IF NOT EXISTS files (run INTEGER, path TEXT, backend TEXT, bytes INTEGER, duration REAL, retries INTEGER, error TEXT);
+                CREATE INDEX IF NOT EXISTS files_run ON files (run);
+                """)
+            metricsRun = metrics.execute('INSERT INTO runs (started, backend) VALUES (?, ?)', (started, backend)).lastrowid
+        metrics.close()
+        if isNew:
+            chownToUser(TRANSFER_METRICS_DB)
+    except Exception as e:
+        log(f'openMetrics error: {e}')
+
+
+def recordFileMetrics(path, backend, numBytes, duration, retries=0, error=None):
+    """
+    error is the class of the exception (or Dropbox/Google error) that stopped the upload, or None if it was successful
+    """
+    metricsFiles.append((path, backend, numBytes, duration, retries, error))
+
+
+def closeMetrics():
+    """
+    Totals up the run, writes it & its files to the metrics store, and prunes the oldest runs
+    """
+    if metricsRun is None:
+        return
+    try:
+        filesOK = [f for f in metricsFiles if f[5] is None]
+        metrics = sqlite3.connect(TRANSFER_METRICS_DB, timeout=30)
+        with metrics:
+            metrics.execute('UPDATE runs SET finished = ?, files = ?, filesOK = ?, bytes = ?, retries = ?, errors = ?, heldOver = ?, status = ? WHERE id = ?',
+                            (time.time(), len(metricsFiles), len(filesOK), sum(f[2] or 0 for f in filesOK), sum(f[4] or 0 for f in metricsFiles),
+                             len(metricsFiles) - len(filesOK), heldOver, lastStatus, metricsRun))
+            metrics.executemany('INSERT INTO files (run, path, backend, bytes, duration, retries, error) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                [(metricsRun,) + f for f in metricsFiles])
+            oldest = metrics.execute('SELECT id FROM runs ORDER BY id DESC LIMIT 1 OFFSET ?', (METRICS_KEEP_RUNS,)).fetchone()
+            if oldest:
+                metrics.execute('DELETE FROM files WHERE run <= ?', (oldest[0],))
+                metrics.execute('DELETE FROM runs WHERE id <= ?', (oldest[0],))
+        metrics.close()
+    except Exception as e:
+        log(f'closeMetrics error: {e}')
+
+
+def pastTransferDeadline():
+    """
+    True once it's time to stop starting new uploads
+    """
+    return transferDeadline is not None and time.time() >= transferDeadline
+
+
+def recordThroughput(numBytes, elapsed):
+    """
+    Saves the speed of this run for the next one's budget. It's a running average, and small runs are ignored as
+    they're mostly connection overhead
+    """
+    if ledger is None or numBytes < 2**20 or elapsed <= 0:
+        return
+    try:
+        rate = numBytes / elapsed
+        previous = ledger.execute("SELECT value FROM meta WHERE key = 'throughput'").fetchone()
+        if previous:
+            rate = (float(previous[0]) + rate) / 2
+        ledger.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('throughput', ?)", (str(rate),))
+        log(f'Upload throughput averages {formatThroughput(rate, 1)}')
+    except Exception as e:
+        log(f'recordThroughput error: {e}')
+
+
+def holdOver(numFiles):
+    """
+    We've run out of time. Anything not yet uploaded waits for the next run
+    """
+    global heldOver
+    with ledgerLock:
+        heldOver += numFiles
+    log(f'The upload deadline has passed. {numFiles} files held over')
+
+
+def heldOverText():
+    """
+    The rider on the closing STATUS line when files have been left for the next run
+    """
+    if heldOver == 0:
+        return ''
+    return f'. {heldOver} held over until next time'
+
+
+def list_New_Images(imagesPath, destination=None, fetchManifest=None):
+    """
+    Returns the images in imagesPath that the ledger doesn't yet have recorded as uploaded, in the order they should be uploaded.
+    scanImages() keeps the ledger's inventory current, so only folders that have changed since the last run are re-read.
+    The ledger tracks each uploadTier separately. An image only needs a low-res copy if its original hasn't been uploaded either.
+    If the backend can read its remote manifests (fetchManifest), images already on the remote are weeded out first.
+    """
+    global imagesScanned
+    with ledgerLock:
+        if not imagesScanned:
+            scanImages(imagesPath)
+            imagesScanned = True
+    scope, params = ledgerScope(destination)
+    with ledgerLock:
+        if uploadTier == 'derivative':
+            rows = ledger.execute(f'SELECT path, folder, mtime, size FROM images i WHERE NOT EXISTS (SELECT 1 FROM uploads u WHERE u.path = i.path AND {scope})',
+                                  params).fetchall()
+        else:
+            rows = ledger.execute(f'SELECT path, folder, mtime, size FROM images i WHERE NOT EXISTS (SELECT 1 FROM uploads u WHERE u.path = i.path AND u.tier = ? AND {scope})',
+                                  (uploadTier,) + params).fetchall()
+    if fetchManifest is not None:
+        rows = reconcileWithRemote(destination, rows, fetchManifest)
+    newFiles = planUploads(scheduleUploads(rows))
+    if destination != 'rsync':
+        registerFanOut(destination, newFiles) # rsync reads the files itself
+    return newFiles
+
+
+def ledgerScope(destination):
+    """
+    The SQL condition (on uploads u) & its parameters for the uploads that count for this destination.
+    Each alsoTransferTo destination only counts its own, and the legacy '*' entries if it's legacyDestination, so a
+    newly added destination is sent the whole archive. tfrMethod counts everything except what's been sent to the
+    other destinations, so changing tfrMethod doesn't resend the archive, as it never has
+    """
+    others = tuple(other for other in destinations if other != destination)
+    if destinations and destination != destinations[0]:
+        if destination == legacyDestination:
+            return "u.destination IN (?, '*')", (destination,)
+        return 'u.destination = ?', (destination,)
+    if not others:
+        return '1', ()
+    return f'u.destination NOT IN ({", ".join("?" * len(others))})', others
+
+
+def scheduleUploads(rows):
+    """
+    If this run has a byte budget (see setTransferBudget), picks the newest files that fit within it. The rest
+    are held over, and as they're still not in the ledger they'll be picked up by the next run.
+    The low-res copies aren't budgeted: they're small, and they go first. The originals get whatever's left.
+    """
+    global heldOver
+    if transferByteBudget is None or uploadTier == 'derivative':
+        return rows
+    selected = []
+    budget = max(0, transferByteBudget - bytesUploaded) // max(1, len(destinations)) # Concurrent destinations share the link
+    for row in sorted(rows, key=lambda row: row[2] or 0, reverse=True):
+        size = row[3] or 0
+        if size > budget:
+            continue # A smaller (older) file might still fit
+        selected.append(row)
+        budget -= size
+    with ledgerLock:
+        heldOver += len(rows) - len(selected)
+    if len(rows) > len(selected):
+        log(f'Scheduled the newest {len(selected)} of {len(rows)} files. {len(rows) - len(selected)} will be held over')
+    return selected
+
+
+def planUploads(rows):
+    """
+    Orders the (path, folder, mtime, size) rows so each folder's files are uploaded together - the remote session only
+    changes directory once per folder - and sorted oldest or newest first (per uploadOrder) within the folder.
+    The folders are in the same order, by their oldest or newest file.
+    """
+    newestFirst = (uploadOrder == 'newest')
+    groups = {}
+    for path, folder, mtime, size in rows:
+        groups.setdefault(folder, []).append((mtime or 0, path))
+    for files in groups.values():
+        files.sort(reverse=newestFirst)
+    folders = sorted(groups, key=lambda folder: groups[folder][0], reverse=newestFirst)
+    newFiles = [path for folder in folders for mtime, path in groups[folder]]
+    log(f'Planned {len(newFiles)} uploads from {len(folders)} folders, {uploadOrder} first')
+    return newFiles
+
+
+def scanImages(imagesPath):
+    """
+    Brings the ledger's inventory of local images up to date.
+    A folder's files are only re-read if the folder's mtime has changed since it was last scanned. (Adding, deleting or
+    renaming a file updates the mtime of its parent folder.)
+    """
+    imagesPath = os.path.expanduser(imagesPath)
+    knownFolders = dict(ledger.execute('SELECT path, mtime FROM folders').fetchall())
+    seenFolders = set()
+    foldersRead = 0
+    scanStarted = time.time()
+    pending = [imagesPath]
+    while pending:
+        folder = pending.pop()
+        try:
+            folderMtime = os.stat(folder).st_mtime
+            entries = list(os.scandir(folder))
+        except Exception as e:
+            log(f'scanImages unable to read {folder}: {e}')
+            continue
+        seenFolders.add(folder)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) and entry.name != '.thumbs':
+                pending.append(entry.path)
+        if knownFolders.get(folder) == folderMtime:
+            continue # Nothing has been added, removed or renamed in here since we last looked
+        foldersRead += 1
+        currentFiles = {}
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if entry.name in ('.directory',):
                 continue
-            ext = os.path.splitext(name)[1].lower()
+            ext = os.path.splitext(entry.name)[1].lower()
             if ext in ('.db',):
                 continue
             if ext in ('.txt',):
                 # Don't try to upload the/any .txt files
                 continue
-            currentlist.append(os.path.join(root, name))
-    for line in fileinput.input(previouslyUploadedFile):
-        lastlist.append(line.rstrip("\n"))
-    newFiles = list(set(currentlist) - set(lastlist))
-    return newFiles
+            try:
+                st = entry.stat()
+                currentFiles[entry.path] = (st.st_size, st.st_mtime)
+            except Exception as e:
+                log(f'scanImages unable to stat {entry.path}: {e}')
+        knownFiles = set(row[0] for row in ledger.execute('SELECT path FROM images WHERE folder = ?', (folder,)))
+        ledger.executemany('DELETE FROM images WHERE path = ?', [(path,) for path in knownFiles - currentFiles.keys()])
+        ledger.executemany('INSERT OR REPLACE INTO images (path, folder, size, mtime) VALUES (?, ?, ?, ?)',
+                           [(path, folder, size, mtime) for path, (size, mtime) in currentFiles.items()])
+        if scanStarted - folderMtime > 2:
+            # Don't trust the mtime of a folder that's still being written to. It'll be re-read next time
+            ledger.execute('INSERT OR REPLACE INTO folders (path, mtime) VALUES (?, ?)', (folder, folderMtime))
+    for folder in knownFolders.keys() - seenFolders:
+        # The folder's gone
+        ledger.execute('DELETE FROM images WHERE folder = ?', (folder,))
+        ledger.execute('DELETE FROM folders WHERE path = ?', (folder,))
+    # Forget any partial uploads of images that are no longer here:
+    ledger.execute('DELETE FROM journal WHERE path NOT IN (SELECT path FROM images)')
+    ledger.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('lastScan', ?)", (str(scanStarted),))
+    ledger.commit()
+    log(f'scanImages read {foldersRead} of {len(seenFolders)} folders')
+
+
+def openLedger():
+    """
+    Opens the upload ledger, creating it if required.
+    The ledger records every image we know about and every image we've uploaded. It replaces the legacy
+    UPLOADED_PHOTOS_LIST text file, which is imported the first time the ledger is opened.
+    """
+    global ledger, legacyDestination
+    try:
+        isNew = not os.path.isfile(UPLOADED_PHOTOS_DB)
+        ledger = sqlite3.connect(UPLOADED_PHOTOS_DB, timeout=30, check_same_thread=False)
+        ledger.execute('PRAGMA journal_mode=WAL')
+        ledger.execute('PRAGMA synchronous=NORMAL')
+        ledger.executescript("""
+            CREATE TABLE IF NOT EXISTS images  (path TEXT PRIMARY KEY, folder TEXT, size INTEGER, mtime REAL);
+            CREATE INDEX IF NOT EXISTS images_folder ON images (folder);
+            CREATE TABLE IF NOT EXISTS uploads (path TEXT, destination TEXT, tier TEXT DEFAULT 'original', size INTEGER, mtime REAL, uploaded REAL,
+                                                PRIMARY KEY (path, destination, tier));
+            CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, mtime REAL);
+            CREATE TABLE IF NOT EXISTS meta    (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS manifest (destination TEXT, folder TEXT, name TEXT, hash TEXT, size INTEGER, PRIMARY KEY (destination, folder, name));
+            CREATE TABLE IF NOT EXISTS journal (path TEXT, destination TEXT, size INTEGER, mtime REAL, offset INTEGER, session TEXT, updated REAL, PRIMARY KEY (path, destination));
+            """)
+        if isNew:
+            chownToUser(UPLOADED_PHOTOS_DB)
+        if 'tier' not in [column[1] for column in ledger.execute('PRAGMA table_info(uploads)')]:
+            addUploadTiers()
+        imported = ledger.execute("SELECT value FROM meta WHERE key = 'legacyImported'").fetchone()
+        if not imported:
+            importUploadedList()
+        legacy = ledger.execute("SELECT value FROM meta WHERE key = 'legacyDestination'").fetchone()
+        if not legacy and destinations:
+            # A ledger imported before the destination was recorded. The best guess is today's tfrMethod:
+            ledger.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacyDestination', ?)", (destinations[0],))
+            ledger.commit()
+            legacy = (destinations[0],)
+        legacyDestination = legacy[0] if legacy else None
+    except Exception as e:
+        log(f'openLedger error: {e}')
+        return False
+    return True
+
+
+def addUploadTiers():
+    """
+    One-time upgrade of a ledger that predates derivativeMode. SQLite can't change a table's primary key, so the
+    uploads table is rebuilt with the tier added. Everything uploaded until now was an original.
+    """
+    ledger.executescript("""
+        ALTER TABLE uploads RENAME TO uploads_old;
+        CREATE TABLE uploads (path TEXT, destination TEXT, tier TEXT DEFAULT 'original', size INTEGER, mtime REAL, uploaded REAL,
+                              PRIMARY KEY (path, destination, tier));
+        INSERT INTO uploads (path, destination, tier, size, mtime, uploaded) SELECT path, destination, 'original', size, mtime, uploaded FROM uploads_old;
+        DROP TABLE uploads_old;
+        """)
+    log('Added upload tiers to the ledger')
+
+
+def importUploadedList():
+    """
+    One-time import of the legacy UPLOADED_PHOTOS_LIST into the ledger.
+    The destination of these isn't in the file, so they're recorded as '*', and today's tfrMethod as the legacyDestination
+    """
+    numImported = 0
+    if os.path.isfile(UPLOADED_PHOTOS_LIST):
+        uploadedTime = os.path.getmtime(UPLOADED_PHOTOS_LIST)
+        rows = []
+        with open(UPLOADED_PHOTOS_LIST, 'r') as historyFile:
+            for line in historyFile:
+                filename = line.rstrip('\n')
+                if not filename:
+                    continue
+                rows.append((filename, '*', None, None, uploadedTime))
+                if len(rows) >= 5000:
+                    ledger.executemany('INSERT OR IGNORE INTO uploads (path, destination, size, mtime, uploaded) VALUES (?, ?, ?, ?, ?)', rows)
+                    numImported += len(rows)
+                    rows = []
+        ledger.executemany('INSERT OR IGNORE INTO uploads (path, destination, size, mtime, uploaded) VALUES (?, ?, ?, ?, ?)', rows)
+        numImported += len(rows)
+    ledger.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacyImported', ?)", (str(time.time()),))
+    if destinations:
+        ledger.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacyDestination', ?)", (destinations[0],))
+    ledger.commit()
+    log(f'Imported {numImported} entries from {UPLOADED_PHOTOS_LIST} into the ledger')
+
+
+def closeLedger():
+    global ledger, ledgerUncommitted
+    if ledger is None:
+        return
+    flushDeletions()
+    try:
+        ledger.commit()
+        ledgerUncommitted = 0
+        ledger.close()
+    except Exception as e:
+        log(f'closeLedger error: {e}')
+    ledger = None
+
+
+def chownToUser(filename):
+    """
+    We're often run with sudo. Hand any file we create back to the Pi's user so the web site and a non-sudo run can still write to it
+    """
+    try:
+        sudo_uid = os.getenv('SUDO_UID')
+        sudo_gid = os.getenv('SUDO_GID')
+        if sudo_uid and sudo_gid:
+            os.chown(filename, int(sudo_uid), int(sudo_gid))
+    except Exception as e:
+        log(f'chownToUser error on {filename}: {e}')
+
+
+def journalGet(filename, destination):
+    """
+    Returns the (offset, session) of an interrupted upload of filename, or None if there isn't one.
+    An entry is ignored if the file has changed since, as the bytes already sent are no longer valid
+    """
+    st = os.stat(filename)
+    with ledgerLock:
+        row = ledger.execute('SELECT size, mtime, offset, session FROM journal WHERE path = ? AND destination = ?', (filename, destination)).fetchone()
+    if row is None or row[0] != st.st_size or row[1] != st.st_mtime:
+        return None
+    return (row[2], row[3])
+
+
+def journalSet(filename, destination, offset, session=None):
+    """
+    Records how far an upload has progressed. This is committed immediately, so it survives a crash or reboot
+    """
+    st = os.stat(filename)
+    with ledgerLock:
+        ledger.execute('INSERT OR REPLACE INTO journal (path, destination, size, mtime, offset, session, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (filename, destination, st.st_size, st.st_mtime, offset, session, time.time()))
+        ledger.commit()
+
+
+def journalClear(filename, destination):
+    with ledgerLock:
+        ledger.execute('DELETE FROM journal WHERE path = ? AND destination = ?', (filename, destination))
+
+
+def resumeOffset(filename, destination, remoteSize):
+    """
+    FTP & SFTP: the size of the remote file is the last byte the server's confirmed. We only append to it if the journal
+    shows it's a partial upload of this same file, otherwise it's overwritten from the start
+    """
+    if journalGet(filename, destination) is None:
+        return 0
+    if 0 < remoteSize < os.path.getsize(filename):
+        log(f'Resuming upload of {filename} at byte {remoteSize}')
+        return remoteSize
+    return 0
 
 
 def makeShortPath(remoteRootFolder, filepath):
@@ -255,7 +820,314 @@ def makeShortPath(remoteRootFolder, filepath):
     return destFilePath
 
 
-def commenceFtp(ftpServer, ftpUser, ftpPassword, ftpRemoteFolder):
+def registerFanOut(destination, newFiles):
+    """
+    alsoTransferTo: notes the images this destination is about to send, so the bytes read by the first destination to
+    open one (see openImage()) are kept for the others
+    """
+    if len(destinations) < 2:
+        return
+    with fanOutLock:
+        for needupload in newFiles:
+            fanOutWaiting.setdefault(needupload, set()).add(destination)
+
+
+def releaseFanOut(destination):
+    """
+    The destination has finished (or given up). Nothing more is kept on its behalf
+    """
+    with fanOutLock:
+        for needupload in list(fanOutWaiting):
+            fanOutWaiting[needupload].discard(destination)
+            if not fanOutWaiting[needupload]:
+                dropFanOut(needupload)
+
+
+def dropFanOut(needupload):
+    """
+    Called with fanOutLock held
+    """
+    global fanOutBytes
+    fanOutWaiting.pop(needupload, None)
+    data = fanOutCache.pop(needupload, None)
+    if data is not None:
+        fanOutBytes -= len(data)
+
+
+def openImage(needupload, destination):
+    """
+    Returns the image open for reading. With one destination that's the file itself. With several, each image is only
+    read from disk once: the first destination to open it keeps its bytes (up to FANOUT_CACHE_BYTES in all) until
+    every other destination waiting on it has had them. A destination that falls too far behind the others reads the
+    image again for itself
+    """
+    global fanOutBytes
+    if len(destinations) < 2:
+        return open(needupload, 'rb')
+    with fanOutLock:
+        waiting = fanOutWaiting.get(needupload, set())
+        waiting.discard(destination)
+        data = fanOutCache.get(needupload)
+        if data is not None:
+            if not waiting:
+                dropFanOut(needupload)
+            return io.BytesIO(data)
+    with open(needupload, 'rb') as f:
+        data = f.read()
+    with fanOutLock:
+        if fanOutWaiting.get(needupload) and needupload not in fanOutCache and fanOutBytes + len(data) <= FANOUT_CACHE_BYTES:
+            fanOutCache[needupload] = data
+            fanOutBytes += len(data)
+    return io.BytesIO(data)
+
+
+def hashFile(filename):
+    """
+    Returns the content hash & size of the image. It's usually in PI_PHOTO_MANIFEST_DB, which intvlm8r wrote as it copied
+    the image off the camera. If it's not there (e.g. it was copied before the store existed), it's calculated here.
+    """
+    known = None
+    photoManifest = openPhotoManifest()
+    if photoManifest is not None:
+        try:
+            known = photoManifest.execute('SELECT hash, size FROM hashes WHERE path = ?', (makeShortPath('', filename),)).fetchone()
+        except Exception as e:
+            log(f'Error reading {PI_PHOTO_MANIFEST_DB}: {e}')
+        finally:
+            photoManifest.close()
+    size = os.path.getsize(filename)
+    if known is not None and known[1] == size:
+        return tuple(known)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return (digest.hexdigest(), size)
+
+
+def openPhotoManifest():
+    """
+    Opens intvlm8r's PI_PHOTO_MANIFEST_DB. It's never created here (we're often run with sudo), so if it's not there yet
+    this returns None, as it does on an error
+    """
+    if not os.path.isfile(PI_PHOTO_MANIFEST_DB):
+        return None
+    try:
+        photoManifest = sqlite3.connect(f'file:{PI_PHOTO_MANIFEST_DB}?mode=rw', uri=True, timeout=30)
+        for sidecar in ('-wal', '-shm'):
+            if os.path.isfile(PI_PHOTO_MANIFEST_DB + sidecar):
+                chownToUser(PI_PHOTO_MANIFEST_DB + sidecar) # In case they're ours. The web site needs to write to them too
+        return photoManifest
+    except Exception as e:
+        log(f'Error opening {PI_PHOTO_MANIFEST_DB}: {e}')
+        return None
+
+
+def recordManifest(filename, destination):
+    """
+    Adds an uploaded image to its remote folder's manifest. The ledger holds the manifests, and the folders that have
+    changed are rewritten to the remote by publishManifests() at the end of the run.
+    Only originals from the DCIM tree are recorded.
+    """
+    shortPath = makeShortPath('', filename)
+    if uploadTier != 'original' or not shortPath.startswith('DCIM/'):
+        return
+    if destination == 'rsync':
+        return # rsync's own quick check (size & mtime) already skips whatever the remote has
+    try:
+        fileHash, size = hashFile(filename)
+        folder, name = os.path.split(shortPath)
+        with ledgerLock:
+            ledger.execute('INSERT OR REPLACE INTO manifest (destination, folder, name, hash, size) VALUES (?, ?, ?, ?, ?)',
+                           (destination, folder, name, fileHash, size))
+        manifestFolders.setdefault(destination, set()).add(folder)
+    except Exception as e:
+        log(f'Error adding {filename} to the manifest: {e}')
+
+
+def remoteManifestPath(remoteFolder, folder):
+    """
+    The absolute path of the remote manifest for the local DCIM/... folder, e.g. /photos/DCIM/100CANON/piManifest.txt
+    """
+    return '/' + '/'.join(level for level in os.path.join(remoteFolder, folder, REMOTE_MANIFEST_NAME).split('/') if level)
+
+
+def reconcileWithRemote(destination, rows, fetchManifest):
+    """
+    If the ledger's been lost (or this is the first run with this destination), every image looks like it needs
+    uploading. Before that happens, the manifest in each of the pending (path, folder, mtime, size) rows' remote folders
+    is fetched (fetchManifest(folder) returns its text, or None), and any image whose content hash matches what's on the
+    remote is recorded as uploaded. This only happens once per destination. Returns the rows that still need uploading.
+    """
+    metaKey = 'reconciled ' + destination
+    if uploadTier != 'original':
+        return rows
+    with ledgerLock:
+        if ledger.execute('SELECT 1 FROM meta WHERE key = ?', (metaKey,)).fetchone():
+            return rows
+    folders = {}
+    for row in rows:
+        shortPath = makeShortPath('', row[0])
+        if shortPath.startswith('DCIM/'):
+            folder, name = os.path.split(shortPath)
+            folders.setdefault(folder, []).append((name, row[0]))
+    reconciled = set()
+    for folder, images in sorted(folders.items()):
+        try:
+            text = fetchManifest(folder)
+        except Exception as e:
+            log(f'Unable to read the remote manifest for {folder}: {e}')
+            continue
+        if not text:
+            continue
+        remote = {}
+        for line in text.splitlines():
+            fields = line.split(' ', 2) # hash size name
+            if len(fields) == 3:
+                remote[fields[2]] = (fields[0], int(fields[1]))
+        with ledgerLock:
+            ledger.executemany('INSERT OR REPLACE INTO manifest (destination, folder, name, hash, size) VALUES (?, ?, ?, ?, ?)',
+                               [(destination, folder, name, fileHash, size) for name, (fileHash, size) in remote.items()])
+        for name, needupload in images:
+            if name not in remote:
+                continue
+            try:
+                st = os.stat(needupload)
+                if st.st_size != remote[name][1] or hashFile(needupload) != remote[name]:
+                    continue # It's changed. Send it again
+                with ledgerLock:
+                    ledger.execute('INSERT OR REPLACE INTO uploads (path, destination, tier, size, mtime, uploaded) VALUES (?, ?, ?, ?, ?, ?)',
+                                   (needupload, destination, 'original', st.st_size, st.st_mtime, time.time()))
+                reconciled.add(needupload)
+            except Exception as e:
+                log(f'Error reconciling {needupload}: {e}')
+    with ledgerLock:
+        ledger.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (metaKey, str(time.time())))
+        ledger.commit()
+    log(f'Reconciled the ledger with the manifests of {len(folders)} remote {destination} folders. {len(reconciled)} images are already there')
+    return [row for row in rows if row[0] not in reconciled]
+
+
+def publishManifests(destination, storeManifest):
+    """
+    Rewrites the remote manifest of each folder that's had images uploaded to it this run. storeManifest(folder, data)
+    does the upload
+    """
+    folders = manifestFolders.pop(destination, set())
+    for folder in sorted(folders):
+        with ledgerLock:
+            rows = ledger.execute('SELECT hash, size, name FROM manifest WHERE destination = ? AND folder = ? ORDER BY name', (destination, folder)).fetchall()
+        try:
+            storeManifest(folder, ''.join(f'{fileHash} {size} {name}\n' for fileHash, size, name in rows).encode('utf-8'))
+        except Exception as e:
+            log(f'Error uploading the manifest for {folder}: {e}')
+    if folders:
+        log(f'Updated the {destination} manifests of {len(folders)} folders')
+
+
+def tierFolder(remoteFolder, derivativeFolder):
+    """
+    The low-res copies go to a parallel tree, e.g. <remoteFolder>/lowres/DCIM/..., beside the originals' <remoteFolder>/DCIM/...
+    """
+    if uploadTier == 'derivative':
+        return os.path.join(remoteFolder, derivativeFolder)
+    return remoteFolder
+
+
+def makeDerivative(needupload, destination):
+    """
+    derivativeMode: makes a low-res JPEG of the image in the destination's folder under PI_DERIVATIVE_DIR, no bigger than
+    derivativeLongEdge on its long edge.
+    A RAW image is made from the preview intvlm8r extracts when it makes the image's thumbnail. A JPEG is decoded at a
+    reduced scale (draft) so a full-size image is never held in memory. The copy takes the original's timestamp and EXIF.
+    Returns the path of the copy, or None if one couldn't be made.
+    """
+    name, ext = os.path.splitext(needupload)
+    derivativeDir = os.path.join(PI_DERIVATIVE_DIR, destination.replace(' ', '')) # Concurrent destinations each make their own
+    source = needupload
+    derivative = name.replace(PI_PHOTO_DIR, derivativeDir, 1) + '.JPG'
+    if ext.lower() not in ('.jpg', '.jpeg'):
+        source = name.replace(PI_PHOTO_DIR, PI_PREVIEW_DIR, 1) + '-preview.JPG'
+        derivative = name.replace(PI_PHOTO_DIR, derivativeDir, 1) + '-' + ext[1:].upper() + '.JPG' # Don't collide with a RAW+JPEG pair's JPEG
+        if not os.path.isfile(source):
+            log(f'No preview of {needupload} to make a low-res copy from')
+            return None
+    try:
+        os.makedirs(os.path.dirname(derivative), exist_ok=True)
+        with (openImage(source, destination) if source == needupload else open(source, 'rb')) as fp, Image.open(fp) as img:
+            exif = img.info.get('exif', b'')
+            img.draft('RGB', (derivativeLongEdge, derivativeLongEdge))
+            img.thumbnail((derivativeLongEdge, derivativeLongEdge), Image.Resampling.LANCZOS)
+            img.convert('RGB').save(derivative, 'JPEG', quality=derivativeQuality, exif=exif)
+        mtime = os.path.getmtime(needupload)
+        os.utime(derivative, (mtime, mtime))
+    except Exception as e:
+        log(f'Error making a low-res copy of {needupload}: {e}')
+        return None
+    return derivative
+
+
+def removeDerivative(localFile, needupload):
+    if localFile and localFile != needupload:
+        try:
+            os.remove(localFile)
+        except Exception as e:
+            log(f'Error deleting low-res copy {localFile}: {e}')
+
+
+def tierUpload(uploadOne, destination):
+    """
+    FTP & SFTP: wraps the uploadOne function handed to uploadFiles() so that in the derivative tier it sends a low-res
+    copy of each image rather than the image itself. Returns the bytes sent
+    """
+    if uploadTier != 'derivative':
+        return uploadOne
+
+    def uploadDerivative(session, needupload):
+        derivative = makeDerivative(needupload, destination)
+        if derivative is None:
+            raise Exception('Unable to make a low-res copy')
+        try:
+            uploadOne(session, derivative)
+            return os.path.getsize(derivative)
+        finally:
+            removeDerivative(derivative, needupload)
+    return uploadDerivative
+
+
+def commenceFtp(ftpServer, ftpUser, ftpPassword, ftpRemoteFolder, concurrency):
+    # The first connection is made here so that a bad server or login aborts the upload with a meaningful STATUS:
+    session = ftpConnect(ftpServer, ftpUser, ftpPassword, True)
+    if session is None:
+        return
+
+    newFiles = list_New_Images(PI_PHOTO_DIR, 'FTP', lambda folder: ftpFetch(session, remoteManifestPath(ftpRemoteFolder, folder)))
+    numNewFiles = len(newFiles)
+    if numNewFiles == 0:
+        log(f'STATUS: No new files to upload{heldOverText()}')
+        ftpClose(session)
+    else:
+        remoteDirs = set()
+        numFilesOK, numBytes, elapsed = uploadFiles(newFiles, 'FTP', concurrency, session,
+                                                    lambda: ftpConnect(ftpServer, ftpUser, ftpPassword, False),
+                                                    tierUpload(lambda session, needupload: ftpUpload(session, needupload, ftpRemoteFolder, remoteDirs), 'FTP'),
+                                                    ftpClose)
+        if manifestFolders.get('FTP'):
+            session = ftpConnect(ftpServer, ftpUser, ftpPassword, False)
+            if session is not None:
+                publishManifests('FTP', lambda folder, data: session['ftp'].storbinary(f'STOR {remoteManifestPath(ftpRemoteFolder, folder)}', io.BytesIO(data)))
+                ftpClose(session)
+        log(f'STATUS: {numFilesOK} of {numNewFiles} files uploaded OK ({formatThroughput(numBytes, elapsed)}){heldOverText()}')
+
+
+def ftpConnect(ftpServer, ftpUser, ftpPassword, reportErrors):
+    """
+    Opens and logs in to an FTP session. Returns the session, or None on failure.
+    Each upload worker has its own session: a connection plus the remote folder it's currently in
+    """
     ftp = FTP()
     ftp.set_debuglevel(2)
     ftpPort = 21
@@ -272,8 +1144,9 @@ def commenceFtp(ftpServer, ftpUser, ftpPassword, ftpRemoteFolder):
             log('FTP connect exception: connection timed out. Destination valid but not listening on port 21')
         else:
             log(f'FTP login exception. Unknown error: {e}')
-        log('STATUS: FTP connection failed')
-        return
+        if reportErrors:
+            log('STATUS: FTP connection failed')
+        return None
     try:
         ftp.login(ftpUser,ftpPassword)
     except Exception as e:
@@ -281,55 +1154,202 @@ def commenceFtp(ftpServer, ftpUser, ftpPassword, ftpRemoteFolder):
             log('FTP login exception: Login or password incorrect')
         else:
             log(f'FTP login exception. Unknown error: {e}')
-        log('STATUS: FTP login failed')
-        return
+        if reportErrors:
+            log('STATUS: FTP login failed')
+        try:
+            ftp.close()
+        except:
+            pass
+        return None
     ftp.set_pasv(False) #Filezilla Server defaults to passive, and 2x passive = nothing happens!
+    return {'ftp': ftp, 'cwd': ''}
 
-    newFiles = list_New_Images(PI_PHOTO_DIR, UPLOADED_PHOTOS_LIST)
-    numNewFiles = len(newFiles)
-    if numNewFiles == 0:
-        log('STATUS: No new files to upload')
-    else:
-        numFilesOK = 0
-        previousFilePath = ''
-        for needupload in newFiles:
-            for retries in range(2):
-                log(f'Uploading {needupload}')
-                # Format the destination path to strip the /home/pi/photos off:
-                shortPath = makeShortPath(ftpRemoteFolder, needupload)
-                try:
-                    remoteFolderTree = os.path.split(shortPath)
-                    if previousFilePath != remoteFolderTree[0]:
-                        # Create the tree & CD to it:
-                        foldersList = remoteFolderTree[0].split("/")
-                        remotePath = "/"
-                        if len(foldersList) != 0:
-                            for oneFolder in foldersList:
-                                remotePath += oneFolder + "/"
-                                try:
-                                    ftp.cwd(remotePath)
-                                except:
-                                    ftp.mkd(oneFolder)
-                                    ftp.cwd(remotePath)
-                    fp = open(needupload, 'rb')
-                    ftp.storbinary(f'STOR {remoteFolderTree[1]}', fp, 1024)
-                    previousFilePath = remoteFolderTree[0]
-                    numFilesOK = uploadedOK(needupload, numFilesOK)
-                    break
-                except Exception as e:
-                    if retries == 0:
-                        log(f'Error on  first attempt uploading {needupload} via FTP: {e}')
-                        time.sleep(1)
-                    else:
-                        log(f'Error on second attempt uploading {needupload} via FTP: {e}')
-        log(f'STATUS: {numFilesOK} of {numNewFiles} files uploaded OK')
+
+def ftpUpload(session, needupload, ftpRemoteFolder, remoteDirs):
+    ftp = session['ftp']
+    # Format the destination path to strip the /home/pi/photos off:
+    shortPath = makeShortPath(ftpRemoteFolder, needupload)
+    remoteFolderTree = os.path.split(shortPath)
+    enterRemoteFolder(session, remoteFolderTree[0], remoteDirs, ftp.cwd, ftp.mkd)
+    remoteName = remoteFolderTree[1]
     try:
-        ftp.quit()
+        ftp.voidcmd('TYPE I') # SIZE is only reliable in binary mode
+        remoteSize = ftp.size(remoteName) or 0
+    except:
+        remoteSize = 0 # Most likely it's not there
+    # A derivative's made afresh each run (with the original's mtime), so its upload's never journalled or resumed:
+    journal = (uploadTier != 'derivative')
+    offset = resumeOffset(needupload, 'FTP', remoteSize) if journal else 0
+    if journal:
+        journalSet(needupload, 'FTP', offset)
+    with openImage(needupload, 'FTP') as fp:
+        if offset:
+            fp.seek(offset)
+            ftp.storbinary(f'APPE {remoteName}', fp, FTP_BLOCKSIZE)
+        else:
+            ftp.storbinary(f'STOR {remoteName}', fp, FTP_BLOCKSIZE)
+    remoteSize = ftp.size(remoteName)
+    if remoteSize != os.path.getsize(needupload):
+        raise Exception(f'Remote file is {remoteSize} bytes. Expected {os.path.getsize(needupload)}')
+    if journal:
+        journalClear(needupload, 'FTP')
+
+
+def ftpFetch(session, remotePath):
+    """
+    Returns the contents of the remote (text) file, or None if it's not there
+    """
+    data = io.BytesIO()
+    try:
+        session['ftp'].retrbinary(f'RETR {remotePath}', data.write)
+    except error_perm:
+        return None
+    return data.getvalue().decode('utf-8')
+
+
+def ftpClose(session):
+    try:
+        session['ftp'].quit()
     except:
         pass
 
 
-def commenceDbx(app_key):
+def uploadFiles(newFiles, method, concurrency, firstSession, openSession, uploadOne, closeSession):
+    """
+    Shares the upload of newFiles between 'concurrency' workers. Each worker owns its own session (connection & remote folder),
+    with the first worker inheriting firstSession. Every result comes back to this thread, so all the ledger accounting
+    (and any deleteAfterTransfer) happens in uploadedOK(), one file at a time. uploadOne can return the bytes it sent, if
+    that's not the size of the file (see tierUpload()).
+    Returns the number of files uploaded OK, the bytes they contained and the elapsed time
+    """
+    fileQueue = queue.Queue()
+    for needupload in newFiles:
+        fileQueue.put(needupload)
+    results = queue.Queue()
+    numWorkers = max(1, min(concurrency, len(newFiles)))
+    log(f'Uploading {len(newFiles)} files via {method} with {numWorkers} worker(s)')
+    destination = getattr(current, 'destination', None) # current is per-thread, so it's handed on to the workers
+
+    def worker(session):
+        current.destination = destination # So log() tags their STATUS & metrics lines with it
+        try:
+            if session is None:
+                session = openSession()
+                if session is None:
+                    log(f'{method} worker unable to open a session. The other worker(s) will continue')
+                    return
+            while not pastTransferDeadline():
+                try:
+                    needupload = fileQueue.get_nowait()
+                except queue.Empty:
+                    break
+                error = None
+                sent = None
+                fileStarted = time.time()
+                for retries in range(2):
+                    log(f'Uploading {needupload}')
+                    try:
+                        sent = uploadOne(session, needupload)
+                        error = None
+                        break
+                    except Exception as e:
+                        error = type(e).__name__
+                        session['cwd'] = '' # We can't be sure where we are. Make the next attempt rebuild the remote path
+                        if retries == 0:
+                            log(f'Error on  first attempt uploading {needupload} via {method}: {e}')
+                            time.sleep(1)
+                        else:
+                            log(f'Error on second attempt uploading {needupload} via {method}: {e}')
+                results.put((needupload, error, time.time() - fileStarted, retries, sent))
+            closeSession(session)
+        except Exception as e:
+            log(f'Unexpected error in {method} upload worker: {e}')
+        finally:
+            results.put(None) # This worker is done
+
+    started = time.time()
+    workers = [threading.Thread(target=worker, args=(firstSession if i == 0 else None,), daemon=True) for i in range(numWorkers)]
+    for thread in workers:
+        thread.start()
+    numFilesOK = 0
+    numBytes = 0
+    workersRunning = numWorkers
+    while workersRunning > 0:
+        result = results.get()
+        if result is None:
+            workersRunning -= 1
+            continue
+        needupload, error, duration, retries, sent = result
+        if error is None:
+            try:
+                fileBytes = os.path.getsize(needupload) if sent is None else sent
+            except:
+                fileBytes = 0
+            numBytes += fileBytes
+            recordFileMetrics(needupload, method, fileBytes, duration, retries)
+            numFilesOK = uploadedOK(needupload, numFilesOK, method, fileBytes)
+        else:
+            recordFileMetrics(needupload, method, 0, duration, retries, error)
+    elapsed = time.time() - started
+    if not fileQueue.empty():
+        if pastTransferDeadline():
+            holdOver(fileQueue.qsize())
+        else:
+            log(f'{fileQueue.qsize()} files were not attempted: no {method} worker was able to connect')
+    return numFilesOK, numBytes, elapsed
+
+
+def enterRemoteFolder(session, remoteFolder, remoteDirs, changeDir, makeDir):
+    """
+    Changes the session to remoteFolder, creating whatever's missing of it.
+    remoteDirs is shared by all of a run's sessions, and holds every remote folder we know exists. A known folder is a
+    single changeDir(). An unknown one is tried whole first, and only if that fails is it built out a level at a time.
+    """
+    if session['cwd'] == remoteFolder:
+        return
+    session['cwd'] = ''
+    levels = []
+    for oneFolder in remoteFolder.split("/"):
+        if oneFolder:
+            levels.append((levels[-1] if levels else '') + '/' + oneFolder)
+    remotePath = levels[-1] if levels else '/'
+    if remotePath in remoteDirs:
+        changeDir(remotePath)
+    else:
+        try:
+            changeDir(remotePath)
+        except Exception:
+            # Create the tree & CD to it. Once one level's been created, those below it can't exist yet:
+            created = False
+            for levelPath in levels:
+                if levelPath in remoteDirs:
+                    continue
+                if not created:
+                    try:
+                        changeDir(levelPath)
+                        continue
+                    except Exception:
+                        pass
+                makeDir(levelPath)
+                created = True
+            changeDir(remotePath)
+        remoteDirs.update(levels)
+    session['cwd'] = remoteFolder
+
+
+def formatThroughput(numBytes, elapsed):
+    """
+    Returns the aggregate throughput as a human-friendly string, e.g. '1.2 MB/s'
+    """
+    if elapsed <= 0:
+        return '- KB/s'
+    rate = numBytes / elapsed
+    if rate >= 2**20:
+        return f'{rate / 2**20:.1f} MB/s'
+    return f'{rate / 2**10:.0f} KB/s'
+
+
+def commenceDbx(app_key, remoteFolder=''):
     if os.path.isfile(DROPBOX_TOKEN):
         try:
             with open(DROPBOX_TOKEN, 'r') as f:
@@ -352,29 +1372,54 @@ def commenceDbx(app_key):
         log(f'Exception signing in to Dropbox: {e}')
         log('STATUS: Exception signing in to Dropbox')
         return
-    newFiles = list_New_Images(PI_PHOTO_DIR, UPLOADED_PHOTOS_LIST)
+    newFiles = list_New_Images(PI_PHOTO_DIR, 'Dropbox', lambda folder: dbx_fetch(dbx, remoteManifestPath(remoteFolder, folder)))
     numNewFiles = len(newFiles)
     if numNewFiles == 0:
-        log('STATUS: No new files to upload')
+        log(f'STATUS: No new files to upload{heldOverText()}')
     else:
         numFilesOK = 0
-        for needupload in newFiles:
+        outOfSpace = False
+        batch = []
+        for index, needupload in enumerate(newFiles):
+            if pastTransferDeadline():
+                holdOver(numNewFiles - index)
+                break
             log(f'Uploading {needupload}')
-            # Format the destination path to strip the /home/pi/photos off:
-            shortPath = makeShortPath('', needupload)
-            path,filename = os.path.split(shortPath)
-            result = dbx_upload(dbx, needupload, path, '', filename)
-            if result == None:
+            fileStarted = time.time()
+            localFile = makeDerivative(needupload, 'Dropbox') if uploadTier == 'derivative' else needupload
+            staged = None
+            if localFile is not None:
+                # Format the destination path to strip the /home/pi/photos off:
+                shortPath = makeShortPath(remoteFolder, localFile)
+                path,filename = os.path.split(shortPath)
+                staged = dbx_upload(dbx, localFile, path, '', filename, journal=(localFile == needupload))
+                removeDerivative(localFile, needupload) # Once it's in the upload session it's no longer needed
+            if staged == None:
                 log(f'Error uploading {needupload} via DBX')
+                recordFileMetrics(needupload, 'Dropbox', 0, time.time() - fileStarted, 0, 'UploadError')
             else:
-                numFilesOK = uploadedOK(needupload, numFilesOK)
-        log(f'STATUS: {numFilesOK} of {numNewFiles} files uploaded OK')
+                batch.append((needupload,) + staged[1:] + (time.time() - fileStarted,))
+            if len(batch) >= DBX_BATCH_SIZE:
+                numFilesOK, outOfSpace = dbx_finish_batch(dbx, batch, numFilesOK)
+                batch = []
+                if outOfSpace:
+                    break
+        if batch:
+            numFilesOK, outOfSpace = dbx_finish_batch(dbx, batch, numFilesOK)
+        if not outOfSpace:
+            publishManifests('Dropbox', lambda folder, data: dbx.files_upload(data, remoteManifestPath(remoteFolder, folder),
+                                                                              mode=dropbox.files.WriteMode.overwrite, mute=True))
+        if outOfSpace:
+            log(f'STATUS: Dropbox upload failed due to insufficient space. {numFilesOK} of {numNewFiles} files uploaded OK')
+        else:
+            log(f'STATUS: {numFilesOK} of {numNewFiles} files uploaded OK{heldOverText()}')
 
 
-def dbx_upload(dbx, fullname, folder, subfolder, name, overwrite=True):
+def dbx_upload(dbx, fullname, folder, subfolder, name, overwrite=True, journal=True):
     """
-    Upload a file.
-    Return the request response, or None in case of error
+    Upload a file to an upload session, ready to be committed by dbx_finish_batch().
+    Return the (fullname, cursor, commit) batch entry, or None in case of error.
+    A derivative isn't journalled (journal=False): it's made afresh each run, so its upload could never be resumed
     """
     path = (f"/{folder}/{subfolder.replace(os.path.sep, '/')}/{name}")
     while '//' in path:
@@ -383,33 +1428,173 @@ def dbx_upload(dbx, fullname, folder, subfolder, name, overwrite=True):
             if overwrite
             else dropbox.files.WriteMode.add)
     mtime = os.path.getmtime(fullname)
+    commit = dropbox.files.CommitInfo(
+        path=path, mode=mode,
+        client_modified=datetime.datetime(*time.gmtime(mtime)[:6]),
+        mute=True)
     try:
-        with open(fullname, 'rb') as f:
-            data = f.read()
+        f = openImage(fullname, 'Dropbox')
     except Exception as e:
         log(f'Dropbox file error: {e}')
         return None
     try:
-        res = dbx.files_upload(
-            data, path, mode,
-            client_modified=datetime.datetime(*time.gmtime(mtime)[:6]),
-            mute=True)
+        with f:
+            cursor = dbx_upload_session(dbx, f, fullname, journal)
     except ApiError as err:
-        if (err.error.is_path() and
-            err.error.get_path().reason.is_insufficient_space()):
-            log('STATUS: Dropbox upload failed due to insufficient space')
-        else:
-            log(f'Dropbox API error {err}')
-            log(f'Dropbox API errormsg text {err.user_message_text}')
-            log('STATUS: Dropbox API error')
+        log(f'Dropbox API error {err}')
+        log(f'Dropbox API errormsg text {err.user_message_text}')
+        log('STATUS: Dropbox API error')
         return None
     except Exception as e:
         log(f'Unexpected Dropbox error: {e}')
         log('STATUS: Exception uploading to Dropbox')
         return None
-    #log(f"Dropbox uploaded as {res.name.encode('utf8')}")
-    #log(f'Dropbox result = {res}')
-    return res
+    return (fullname, cursor, commit)
+
+
+def dbx_upload_session(dbx, f, fullname, journal=True):
+    """
+    Streams the open file f to a new upload session in UPLOAD_CHUNK_SIZE chunks, closing the session with the last one.
+    If journal, the session id & offset are journalled after every chunk, so an interrupted upload resumes from the last chunk
+    Dropbox confirmed (sessions last for up to a week). Returns the session's cursor
+    """
+    size = os.path.getsize(fullname)
+    cursor = None
+    restarted = False
+    journalled = journalGet(fullname, 'Dropbox') if journal else None
+    if journalled is not None and journalled[1]:
+        cursor = dropbox.files.UploadSessionCursor(session_id=journalled[1], offset=journalled[0])
+        if cursor.offset >= size:
+            # It's all there, and the session's closed. Only the commit didn't happen
+            return cursor
+        log(f'Resuming Dropbox upload of {fullname} at byte {cursor.offset}')
+    while True:
+        if cursor is None:
+            f.seek(0)
+            data = f.read(UPLOAD_CHUNK_SIZE)
+            result = dbx.files_upload_session_start(data, close=(len(data) >= size))
+            cursor = dropbox.files.UploadSessionCursor(session_id=result.session_id, offset=len(data))
+        else:
+            f.seek(cursor.offset)
+            data = f.read(UPLOAD_CHUNK_SIZE)
+            try:
+                dbx.files_upload_session_append_v2(data, cursor, close=(cursor.offset + len(data) >= size))
+            except ApiError as err:
+                lookupError = dbx_lookup_error(err)
+                if lookupError is None:
+                    raise
+                if lookupError.is_incorrect_offset():
+                    # Dropbox has more (or less) of the file than we thought. Carry on from where it's up to
+                    cursor.offset = lookupError.get_incorrect_offset().correct_offset
+                    log(f'Dropbox upload of {fullname} continuing from byte {cursor.offset}')
+                    continue
+                if restarted:
+                    raise
+                # The session has expired or been closed. Start again:
+                log(f'Dropbox upload session for {fullname} is no longer valid. Restarting: {err}')
+                restarted = True
+                cursor = None
+                if journal:
+                    journalClear(fullname, 'Dropbox')
+                continue
+            cursor.offset += len(data)
+        if journal:
+            journalSet(fullname, 'Dropbox', cursor.offset, cursor.session_id)
+        if cursor.offset >= size:
+            return cursor
+
+
+def dbx_finish_batch(dbx, batch, numFilesOK):
+    """
+    Commits all the (fullname, cursor, commit, duration) upload sessions in batch with the one call, and records each file that succeeded.
+    Returns the updated numFilesOK, and True if Dropbox has run out of space
+    """
+    outOfSpace = False
+    entries = [dropbox.files.UploadSessionFinishArg(cursor=cursor, commit=commit) for (fullname, cursor, commit, duration) in batch]
+    log(f'Committing a batch of {len(entries)} files to Dropbox')
+    try:
+        if hasattr(dbx, 'files_upload_session_finish_batch_v2'):
+            result = dbx.files_upload_session_finish_batch_v2(entries)
+        else:
+            # Older SDKs only have the async version
+            launch = dbx.files_upload_session_finish_batch(entries)
+            if launch.is_complete():
+                result = launch.get_complete()
+            else:
+                while True:
+                    time.sleep(1)
+                    jobStatus = dbx.files_upload_session_finish_batch_check(launch.get_async_job_id())
+                    if jobStatus.is_complete():
+                        result = jobStatus.get_complete()
+                        break
+    except ApiError as err:
+        log(f'Dropbox API error {err}')
+        log(f'Dropbox API errormsg text {err.user_message_text}')
+        log('STATUS: Dropbox API error')
+        for (fullname, cursor, commit, duration) in batch:
+            recordFileMetrics(fullname, 'Dropbox', 0, duration, 0, 'ApiError')
+        return numFilesOK, outOfSpace
+    except Exception as e:
+        log(f'Unexpected Dropbox error: {e}')
+        log('STATUS: Exception uploading to Dropbox')
+        for (fullname, cursor, commit, duration) in batch:
+            recordFileMetrics(fullname, 'Dropbox', 0, duration, 0, type(e).__name__)
+        return numFilesOK, outOfSpace
+    for (fullname, cursor, commit, duration), entry in zip(batch, result.entries):
+        if entry.is_success():
+            journalClear(fullname, 'Dropbox')
+            recordFileMetrics(fullname, 'Dropbox', cursor.offset, duration)
+            numFilesOK = uploadedOK(fullname, numFilesOK, 'Dropbox', cursor.offset)
+            continue
+        error = entry.get_failure()
+        errorClass = type(error).__name__
+        if dbx_insufficient_space(error):
+            outOfSpace = True
+            errorClass = 'InsufficientSpace'
+        elif hasattr(error, 'is_lookup_failed') and error.is_lookup_failed():
+            # The session's no good. Start this one afresh next time
+            journalClear(fullname, 'Dropbox')
+            errorClass = 'LookupFailed'
+        recordFileMetrics(fullname, 'Dropbox', 0, duration, 0, errorClass)
+        log(f'Error committing {fullname} to Dropbox: {error}')
+    return numFilesOK, outOfSpace
+
+
+def dbx_fetch(dbx, path):
+    """
+    Returns the contents of the Dropbox (text) file, or None if it's not there
+    """
+    try:
+        metadata, response = dbx.files_download(path)
+    except ApiError as err:
+        if err.error.is_path() and err.error.get_path().is_not_found():
+            return None
+        raise
+    return response.content.decode('utf-8')
+
+
+def dbx_lookup_error(err):
+    """
+    Returns the upload session lookup error wrapped in an append or finish ApiError, or None if it's not one
+    """
+    error = err.error
+    if hasattr(error, 'is_lookup_failed') and error.is_lookup_failed():
+        error = error.get_lookup_failed()
+    if hasattr(error, 'is_incorrect_offset'):
+        return error
+    return None
+
+
+def dbx_insufficient_space(error):
+    """
+    True if the upload error (an UploadError or UploadSessionFinishError) is because the Dropbox is full.
+    The former reports it as an UploadWriteFailed, the latter as a bare WriteError
+    """
+    if not (hasattr(error, 'is_path') and error.is_path()):
+        return False
+    writeError = error.get_path()
+    writeError = getattr(writeError, 'reason', writeError)
+    return writeError.is_insufficient_space()
 
 
 def reauthDropbox(APP_KEY):
@@ -459,7 +1644,36 @@ def reauthDropbox(APP_KEY):
     return 1
 
 
-def commenceSftp(sftpServer, sftpUser, sftpPassword, sftpRemoteFolder):
+def commenceSftp(sftpServer, sftpUser, sftpPassword, sftpRemoteFolder, concurrency):
+    # The first connection is made here so that a bad server or login aborts the upload with a meaningful STATUS:
+    session = sftpConnect(sftpServer, sftpUser, sftpPassword, True)
+    if session is None:
+        return
+
+    newFiles = list_New_Images(PI_PHOTO_DIR, 'SFTP', lambda folder: sftpFetch(session, remoteManifestPath(sftpRemoteFolder, folder)))
+    numNewFiles = len(newFiles)
+    if numNewFiles == 0:
+        log(f'STATUS: No files to upload{heldOverText()}')
+        sftpClose(session)
+    else:
+        remoteDirs = set()
+        numFilesOK, numBytes, elapsed = uploadFiles(newFiles, 'SFTP', concurrency, session,
+                                                    lambda: sftpConnect(sftpServer, sftpUser, sftpPassword, False),
+                                                    tierUpload(lambda session, needupload: sftpUpload(session, needupload, sftpRemoteFolder, remoteDirs), 'SFTP'),
+                                                    sftpClose)
+        if manifestFolders.get('SFTP'):
+            session = sftpConnect(sftpServer, sftpUser, sftpPassword, False)
+            if session is not None:
+                publishManifests('SFTP', lambda folder, data: session['sftp'].putfo(io.BytesIO(data), remoteManifestPath(sftpRemoteFolder, folder)))
+                sftpClose(session)
+        log(f'STATUS: {numFilesOK} of {numNewFiles} files uploaded OK ({formatThroughput(numBytes, elapsed)}){heldOverText()}')
+
+
+def sftpConnect(sftpServer, sftpUser, sftpPassword, reportErrors):
+    """
+    Opens an SSH connection & SFTP session. Returns the session, or None on failure.
+    Each upload worker has its own session: a connection plus the remote folder it's currently in
+    """
     # now, connect and use paramiko Transport to negotiate SSH2 across the connection
     try:
         ssh = paramiko.SSHClient()
@@ -488,69 +1702,85 @@ def commenceSftp(sftpServer, sftpUser, sftpPassword, sftpRemoteFolder):
         sftp = ssh.open_sftp()
     except paramiko.AuthenticationException as e:
         log(f'Authentication failed: {e}')
-        log('STATUS: SFTP Authentication failed')
-        return
+        if reportErrors:
+            log('STATUS: SFTP Authentication failed')
+        return None
     except paramiko.SSHException as e:
         log(f'Unable to establish SSH connection: {e}')
-        if ('Connection timed out' in str(e)):
-            log(f'STATUS: SFTP timed out connecting to {sftpServer}')
-        else:
-            log('STATUS: SFTP Unable to establish SSH connection')
-        return
+        if reportErrors:
+            if ('Connection timed out' in str(e)):
+                log(f'STATUS: SFTP timed out connecting to {sftpServer}')
+            else:
+                log('STATUS: SFTP Unable to establish SSH connection')
+        return None
     except paramiko.BadHostKeyException as e:
         log(f"Unable to verify server's host key: {e}")
-        log("STATUS: SFTP Unable to verify server's host key")
-        return
+        if reportErrors:
+            log("STATUS: SFTP Unable to verify server's host key")
+        return None
     except Exception as e:
         log(f'Exception signing in to SFTP server: {e}')
-        log('STATUS: SFTP exception signing in')
-        return
+        if reportErrors:
+            log('STATUS: SFTP exception signing in')
+        return None
+    return {'ssh': ssh, 'sftp': sftp, 'cwd': ''}
 
-    newFiles = list_New_Images(PI_PHOTO_DIR, UPLOADED_PHOTOS_LIST)
-    numNewFiles = len(newFiles)
-    if numNewFiles == 0:
-        log('STATUS: No files to upload')
-    else:
-        numFilesOK = 0
-        previousFilePath = ''
-        for needupload in newFiles:
-            for retries in range(2):
-                log(f'Uploading {needupload}')
-                # Format the destination path to strip the /home/pi/photos off:
-                shortPath = makeShortPath(sftpRemoteFolder, needupload)
-                try:
-                    remoteFolderTree = os.path.split(shortPath)
-                    if previousFilePath != remoteFolderTree[0]:
-                        # Create the tree & CD to it:
-                        foldersList = remoteFolderTree[0].split("/")
-                        remotePath = "/"
-                        if len(foldersList) != 0:
-                            for oneFolder in foldersList:
-                                remotePath += oneFolder + "/"
-                                try:
-                                    sftp.chdir(remotePath)
-                                except IOError:
-                                    sftp.mkdir(oneFolder)
-                                    sftp.chdir(remotePath)
-                                except Exception as e:
-                                    log(f'Unexpected path/folder error in SFTP: {e}')
-                    sftp.put(needupload, remoteFolderTree[1])
-                    previousFilePath = remoteFolderTree[0]
-                    numFilesOK = uploadedOK(needupload, numFilesOK)
+
+def sftpUpload(session, needupload, sftpRemoteFolder, remoteDirs):
+    sftp = session['sftp']
+    # Format the destination path to strip the /home/pi/photos off:
+    shortPath = makeShortPath(sftpRemoteFolder, needupload)
+    remoteFolderTree = os.path.split(shortPath)
+    enterRemoteFolder(session, remoteFolderTree[0], remoteDirs, sftp.chdir, sftp.mkdir)
+    remoteName = remoteFolderTree[1]
+    try:
+        remoteSize = sftp.stat(remoteName).st_size
+    except IOError:
+        remoteSize = 0 # It's not there
+    # A derivative's made afresh each run (with the original's mtime), so its upload's never journalled or resumed:
+    journal = (uploadTier != 'derivative')
+    offset = resumeOffset(needupload, 'SFTP', remoteSize) if journal else 0
+    if journal:
+        journalSet(needupload, 'SFTP', offset)
+    if offset:
+        with openImage(needupload, 'SFTP') as localFile, sftp.open(remoteName, 'r+b') as remoteFile:
+            localFile.seek(offset)
+            remoteFile.seek(offset)
+            remoteFile.set_pipelined(True)
+            while True:
+                data = localFile.read(UPLOAD_CHUNK_SIZE)
+                if not data:
                     break
-                except Exception as e:
-                    if retries == 0:
-                        log(f'Error on  first attempt uploading {needupload} via SFTP: {e}')
-                        time.sleep(1)
-                    else:
-                        log(f'Error on second attempt uploading {needupload} via SFTP: {e}')
-        log(f'STATUS: {numFilesOK} of {numNewFiles} files uploaded OK')
+                remoteFile.write(data)
+        remoteSize = sftp.stat(remoteName).st_size
+        if remoteSize != os.path.getsize(needupload):
+            raise Exception(f'Remote file is {remoteSize} bytes. Expected {os.path.getsize(needupload)}')
+    else:
+        with openImage(needupload, 'SFTP') as localFile:
+            sftp.putfo(localFile, remoteName, os.path.getsize(needupload)) # putfo() confirms the remote file's size
+    if journal:
+        journalClear(needupload, 'SFTP')
+
+
+def sftpFetch(session, remotePath):
+    """
+    Returns the contents of the remote (text) file, or None if it's not there
+    """
+    data = io.BytesIO()
     try:
-        sftp.close()
+        session['sftp'].getfo(remotePath, data)
+    except IOError:
+        return None
+    return data.getvalue().decode('utf-8')
+
+
+def sftpClose(session):
+    try:
+        session['sftp'].close()
     except:
         pass
     try:
-        ssh.close()
+        session['ssh'].close()
     except:
         pass
 
@@ -595,48 +1825,63 @@ def commenceGoogle(remoteFolder):
         log(f'Error creating Google DRIVE object: {e}')
         log('STATUS: Error creating Google DRIVE object')
         return 0
-    newFiles = list_New_Images(PI_PHOTO_DIR, UPLOADED_PHOTOS_LIST)
+    folderCache = loadGoogleFolderCache()
+    newFiles = list_New_Images(PI_PHOTO_DIR, 'Google Drive',
+                               lambda folder: googleFetch(DRIVE, os.path.join(remoteFolder, folder), REMOTE_MANIFEST_NAME, folderCache))
     numNewFiles = len(newFiles)
     if numNewFiles == 0:
-        log('STATUS: No files to upload')
+        log(f'STATUS: No files to upload{heldOverText()}')
     else:
         numFilesOK = 0
-        previousFilePath = ''
-        for needupload in newFiles:
+        # Resolve every destination folder up front. The cache means this is usually without a single query:
+        remoteFolders = sorted(set(os.path.split(makeShortPath(remoteFolder, needupload))[0] for needupload in newFiles))
+        for remoteFolderPath in remoteFolders:
+            if resolveGoogleFolder(DRIVE, remoteFolderPath, folderCache) is None:
+                saveGoogleFolderCache(folderCache)
+                log('Aborted uploading to Google. Error creating newFolder')
+                log(f'STATUS: Google upload aborted. {numFilesOK} of {numNewFiles} files uploaded OK')
+                return 0
+        saveGoogleFolderCache(folderCache)
+        quotaExceeded = False
+        for index, needupload in enumerate(newFiles):
+            if pastTransferDeadline():
+                holdOver(numNewFiles - index)
+                break
             log(f'Uploading {needupload}')
+            fileStarted = time.time()
+            localFile = makeDerivative(needupload, 'Google Drive') if uploadTier == 'derivative' else needupload
+            if localFile is None:
+                recordFileMetrics(needupload, 'Google Drive', 0, time.time() - fileStarted, 0, 'UploadError')
+                continue
             # Format the destination path to strip the /home/pi/photos off:
-            shortPath = makeShortPath(remoteFolder, needupload)
+            shortPath = makeShortPath(remoteFolder, localFile)
             log(f'ShortPath: {shortPath}')
             remoteFolderTree = os.path.split(shortPath)
-            if previousFilePath != remoteFolderTree[0]:
-                ImageParentId = None
-                # Confirm the tree exists, or build it out:
-                foldersList = remoteFolderTree[0].split("/")
-                if len(foldersList) != 0:
-                    for oneFolder in foldersList:
-                        childFolderId = getGoogleFolder(DRIVE, oneFolder, ImageParentId)
-                        if childFolderId is None:
-                            #Nope, that folder doesn't exist. Create it:
-                            newFolderId = createGoogleFolder(DRIVE, oneFolder, ImageParentId)
-                            if newFolderId is None:
-                                log('Aborted uploading to Google. Error creating newFolder')
-                                log(f'STATUS: Google upload aborted. {numFilesOK} of {numNewFiles} files uploaded OK')
-                                return 0
-                            else:
-                                ImageParentId = newFolderId
-                        else:
-                            ImageParentId = childFolderId
-            #By here we have the destination path id
             #Now upload the file
             file_name = remoteFolderTree[1]
+            retries = 0
             try:
-                media = MediaFileUpload(needupload, mimetype='image/jpeg')
-                result = DRIVE.files().insert(media_body=media, body={'title':file_name, 'parents':[{u'id': ImageParentId}]}).execute()
+                try:
+                    result = googleUpload(DRIVE, localFile, {'title':file_name, 'parents':[{u'id': folderCache[remoteFolderTree[0]]}]})
+                except HttpError as e:
+                    if e.resp.status != 404:
+                        raise
+                    # The cached folder (or one above it) has been deleted. Look it up again & have another go:
+                    log(f"Google folder '{remoteFolderTree[0]}' not found. Refreshing the folder cache")
+                    invalidateGoogleFolder(remoteFolderTree[0], folderCache)
+                    if resolveGoogleFolder(DRIVE, remoteFolderTree[0], folderCache) is None:
+                        raise
+                    saveGoogleFolderCache(folderCache)
+                    retries = 1
+                    result = googleUpload(DRIVE, localFile, {'title':file_name, 'parents':[{u'id': folderCache[remoteFolderTree[0]]}]})
                 if result is not None:
-                    numFilesOK = uploadedOK(needupload, numFilesOK)
+                    recordFileMetrics(needupload, 'Google Drive', os.path.getsize(localFile), time.time() - fileStarted, retries)
+                    numFilesOK = uploadedOK(needupload, numFilesOK, 'Google Drive', os.path.getsize(localFile))
                 else:
                     log(f"Bad result uploading '{needupload}' to Google: {result}")
+                    recordFileMetrics(needupload, 'Google Drive', 0, time.time() - fileStarted, retries, 'BadResult')
             except Exception as e:
+                recordFileMetrics(needupload, 'Google Drive', 0, time.time() - fileStarted, retries, type(e).__name__)
                 errorMsg = str(e)
                 log(f'Error uploading {needupload} via Google: {errorMsg}')
                 if 'returned' in errorMsg:
@@ -644,19 +1889,189 @@ def commenceGoogle(remoteFolder):
                     log(f'STATUS: Google error: {errorReason}')
                     if 'The user has exceeded their Drive storage quota' in errorReason:
                         log('Google upload aborted - no space')
-                        return 0
-            previousFilePath = remoteFolderTree[0]
-        log(f'STATUS: {numFilesOK} of {numNewFiles} files uploaded OK')
+                        quotaExceeded = True
+            removeDerivative(localFile, needupload)
+            if quotaExceeded:
+                break # The manifests & folder cache still need saving for what did make it
+        publishManifests('Google Drive', lambda folder, data: googleStore(DRIVE, os.path.join(remoteFolder, folder), REMOTE_MANIFEST_NAME, data, folderCache))
+        saveGoogleFolderCache(folderCache)
+        if quotaExceeded:
+            log(f'STATUS: Google upload aborted - no space. {numFilesOK} of {numNewFiles} files uploaded OK')
+        else:
+            log(f'STATUS: {numFilesOK} of {numNewFiles} files uploaded OK{heldOverText()}')
     return 0
 
 
+def loadGoogleFolderCache():
+    """
+    Returns the cache of remote folder paths & their Google Drive ids
+    """
+    try:
+        with open(GOOGLE_FOLDERS_CACHE, 'r') as f:
+            folderCache = json.load(f)
+        if isinstance(folderCache, dict):
+            return folderCache
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log(f'Error reading the Google folder cache. Starting afresh: {e}')
+    return {}
+
+
+def saveGoogleFolderCache(folderCache):
+    try:
+        isNew = not os.path.isfile(GOOGLE_FOLDERS_CACHE)
+        tempName = GOOGLE_FOLDERS_CACHE + '.tmp'
+        with open(tempName, 'w') as f:
+            json.dump(folderCache, f, indent=0, sort_keys=True)
+        os.replace(tempName, GOOGLE_FOLDERS_CACHE)
+        if isNew:
+            chownToUser(GOOGLE_FOLDERS_CACHE)
+    except Exception as e:
+        log(f'Error saving the Google folder cache: {e}')
+
+
+def resolveGoogleFolder(DRIVE, remoteFolderPath, folderCache, create=True):
+    """
+    Returns the id of the remote folder, finding or creating each level of the path that isn't already in the cache.
+    With create=False a missing level isn't created, and None is returned.
+    Cached ids aren't checked here. If one's gone stale the upload will fail with a 404, and invalidateGoogleFolder() removes it
+    """
+    parentId = None
+    levelPath = ''
+    for oneFolder in remoteFolderPath.split("/"):
+        levelPath = oneFolder if levelPath == '' else levelPath + '/' + oneFolder
+        folderId = folderCache.get(levelPath)
+        if folderId is None:
+            folderId = getGoogleFolder(DRIVE, oneFolder, parentId)
+            if folderId is None:
+                if not create:
+                    return None
+                #Nope, that folder doesn't exist. Create it:
+                folderId = createGoogleFolder(DRIVE, oneFolder, parentId)
+                if folderId is None:
+                    return None
+            folderCache[levelPath] = folderId
+        parentId = folderId
+    return parentId
+
+
+def invalidateGoogleFolder(remoteFolderPath, folderCache):
+    """
+    Drops the folder and each of its parents from the cache. We don't know which level was deleted, but whichever
+    are still there will be found again by name
+    """
+    levelPath = ''
+    for oneFolder in remoteFolderPath.split("/"):
+        levelPath = oneFolder if levelPath == '' else levelPath + '/' + oneFolder
+        folderCache.pop(levelPath, None)
+
+
+def googleUpload(DRIVE, needupload, body):
+    """
+    Uploads the file in chunks as a resumable upload. The session URI & offset are journalled after every chunk, so an
+    interrupted upload asks Google how much it received, and resumes from there
+    """
+    journal = journalGet(needupload, 'Google Drive')
+    with openImage(needupload, 'Google Drive') as fp:
+        while True:
+            media = MediaIoBaseUpload(fp, mimetype='image/jpeg', chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+            request = DRIVE.files().insert(media_body=media, body=body)
+            response = None
+            if journal is not None and journal[1]:
+                offset, response = googleUploadStatus(request, journal[1], media.size())
+                if offset is None:
+                    # The session has expired. Start again:
+                    log(f'Google upload session for {needupload} is no longer valid. Restarting')
+                    journal = None
+                    journalClear(needupload, 'Google Drive')
+                    continue
+                if response is None:
+                    log(f'Resuming Google upload of {needupload} from byte {offset}')
+                request.resumable_uri = journal[1]
+                request.resumable_progress = offset # next_chunk() carries on from here
+            try:
+                while response is None:
+                    status, response = request.next_chunk()
+                    if response is None:
+                        journalSet(needupload, 'Google Drive', request.resumable_progress, request.resumable_uri)
+            except HttpError as e:
+                if journal is not None and e.resp.status in (404, 410):
+                    # The session has expired. Start again:
+                    log(f'Google upload session for {needupload} is no longer valid. Restarting')
+                    journal = None
+                    journalClear(needupload, 'Google Drive')
+                    continue
+                raise
+            journalClear(needupload, 'Google Drive')
+            return response
+
+
+def googleUploadStatus(request, resumableUri, size):
+    """
+    Asks Google how much of an interrupted resumable upload it has: an empty PUT with 'Content-Range: bytes */size'.
+    Returns (offset, None) to carry on from, (size, response) if it's all there already, or (None, None) if the session's no good
+    """
+    resp, content = request.http.request(resumableUri, method='PUT', body='',
+                                         headers={'Content-Length': '0', 'Content-Range': f'bytes */{size}'})
+    if resp.status == 308:
+        # 'Range: bytes=0-n' is what it has. No Range means nothing has arrived yet
+        received = resp.get('range')
+        return (int(received.split('-')[-1]) + 1 if received else 0), None
+    if resp.status in (200, 201):
+        return size, json.loads(content)
+    log(f'Google upload status check returned {resp.status}')
+    return None, None
+
+
+def googleFindFile(DRIVE, title, parentId):
+    """
+    Returns the id of the (non-folder) file in the parent folder, or None if it's not there
+    """
+    q = []
+    q.append("title='%s'" % title.replace("'", "\\'"))
+    q.append("'%s' in parents" % parentId.replace("'", "\\'"))
+    q.append("mimeType != 'application/vnd.google-apps.folder'")
+    q.append("trashed=false")
+    files = DRIVE.files().list(q=' and '.join(q)).execute()
+    if files['items']:
+        return files['items'][0]['id']
+    return None
+
+
+def googleFetch(DRIVE, remoteFolderPath, title, folderCache):
+    """
+    Returns the contents of the remote (text) file, or None if it (or its folder) isn't there. Reading never creates a folder
+    """
+    parentId = resolveGoogleFolder(DRIVE, remoteFolderPath, folderCache, create=False)
+    fileId = googleFindFile(DRIVE, title, parentId) if parentId else None
+    if fileId is None:
+        return None
+    return DRIVE.files().get_media(fileId=fileId).execute().decode('utf-8')
+
+
+def googleStore(DRIVE, remoteFolderPath, title, data, folderCache):
+    """
+    Creates or overwrites the remote file with data
+    """
+    parentId = resolveGoogleFolder(DRIVE, remoteFolderPath, folderCache)
+    if parentId is None:
+        raise Exception(f"Unable to find or create the folder '{remoteFolderPath}'")
+    media = MediaIoBaseUpload(io.BytesIO(data), mimetype='text/plain')
+    fileId = googleFindFile(DRIVE, title, parentId)
+    if fileId is None:
+        DRIVE.files().insert(media_body=media, body={'title': title, 'parents': [{'id': parentId}]}).execute()
+    else:
+        DRIVE.files().update(fileId=fileId, media_body=media).execute()
+
+
 def getGoogleFolder(DRIVE, remoteFolder, parent=None):
     """
     Find and return the id of the remote folder
     """
     log(f"Testing if folder '{remoteFolder}' exists.")
     q = []
-    q.append("title='{remoteFolder}'")
+    q.append("title='%s'" % remoteFolder.replace("'", "\\'"))
     if parent is not None:
         q.append("'%s' in parents" % parent.replace("'", "\\'"))
     q.append("mimeType contains 'application/vnd.google-apps.folder'")
@@ -741,12 +2156,23 @@ def commenceRsync(rsyncUsername, rsyncHost, rsyncRemoteFolder):
     numFilesOK = cleanupRsync() #Safety net.
     if numFilesOK != 0:
         log(f'rsync cleaned {numFilesOK} files previously uploaded OK')
-    newFiles = list_New_Images(PI_PHOTO_DIR, UPLOADED_PHOTOS_LIST)
-    numNewFiles = len(newFiles)
+    newFiles = list_New_Images(PI_PHOTO_DIR, 'rsync')
+    # rsync only ever sends the DCIM tree. Hand it just the files that are pending, relative to PI_PHOTO_DIR, so the
+    # remote end sees the same DCIM/... paths as before but neither end has to walk the whole archive:
+    dcimPath = os.path.join(PI_PHOTO_DIR, 'DCIM') + '/'
+    relativeFiles = [os.path.relpath(needupload, PI_PHOTO_DIR) for needupload in newFiles if needupload.startswith(dcimPath)]
+    numNewFiles = len(relativeFiles)
     if numNewFiles == 0:
-        log('STATUS: No files to upload')
+        log(f'STATUS: No files to upload{heldOverText()}')
     else:
-        localPath  = os.path.join(PI_PHOTO_DIR, 'DCIM')
+        try:
+            with open(RSYNC_FILES_LIST, 'w') as filesList:
+                filesList.write('\n'.join(relativeFiles) + '\n')
+        except Exception as e:
+            log(f'Error writing the rsync files list: {e}')
+            log('STATUS: rsync error writing the files list')
+            return 0
+        localPath  = PI_PHOTO_DIR + '/'
         for retries in range(2):
             try:
                 log(f'rsync retries = {retries}.') # Temp TEST logging line
@@ -756,9 +2182,18 @@ def commenceRsync(rsyncUsername, rsyncHost, rsyncRemoteFolder):
                 if rsyncRemoteFolder and (not rsyncRemoteFolder.endswith('/')):
                     rsyncRemoteFolder += '/'
                 destination = rsyncUsername + '@' + rsyncHost + ':' + rsyncRemoteFolder
-                cmd = ['/usr/bin/rsync', '-avz', '--rsh=/usr/bin/ssh', '--log-file=' + RSYNC_LOG_FILE, '--log-file-format=Copied %f', localPath, destination]
+                cmd = ['/usr/bin/rsync', '-avz', '--partial', '--files-from=' + RSYNC_FILES_LIST, '--rsh=/usr/bin/ssh', '--log-file=' + RSYNC_LOG_FILE, '--log-file-format=Copied %f', localPath, destination]
                 result = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False, encoding='utf-8')
-                (stdoutdata, stderrdata) = result.communicate()
+                try:
+                    (stdoutdata, stderrdata) = result.communicate(timeout=(None if transferDeadline is None else max(1, transferDeadline - time.time())))
+                except subprocess.TimeoutExpired:
+                    # Out of time. --partial means rsync picks up where it left off next time
+                    result.terminate()
+                    result.communicate()
+                    numFilesOK = cleanupRsync()
+                    log('rsync stopped at the upload deadline')
+                    log(f'STATUS: {numFilesOK} files uploaded OK. The rest are held over until next time')
+                    break
                 if stdoutdata:
                     stdoutdata = stdoutdata.strip()
                     #log(f'rsync stdoutdata = {stdoutdata}.')
@@ -804,49 +2239,136 @@ def cleanupRsync():
     """
     Called twice: first on entry to commenceRsync and again on exit.
     The first pass is a safety net. If the Pi was previously shutdown while rsync was still running, files that HAD
-    been transferred won't have been added to the UPLOADED_PHOTOS_LIST, nor deleted if deleteAfterTransfer is active.
-    The second pass is upon the successful completion of an rsync upload.    """
+    been transferred won't have been recorded in the ledger, nor deleted if deleteAfterTransfer is active.
+    The second pass is upon the successful completion of an rsync upload.
+    Only the part of the log written since the last pass is read. The ledger holds the offset we've read up to.
+    """
     log('cleanupRsync - entered')
     numFilesOK = 0
     try:
-        with open(RSYNC_LOG_FILE, "r") as logfile:
-            with open(RSYNC_TMP_FILE, "w") as tempfile:
-                for oneLine in logfile.readlines():
+        with ledgerLock:
+            offset = ledger.execute("SELECT value FROM meta WHERE key = 'rsyncLogOffset'").fetchone()
+        offset = int(offset[0]) if offset else 0
+        if not os.path.isfile(RSYNC_LOG_FILE):
+            offset = 0
+        else:
+            if os.path.getsize(RSYNC_LOG_FILE) < offset:
+                offset = 0 # The log's been cleared or replaced since we last looked
+            with open(RSYNC_LOG_FILE, 'rb') as logfile:
+                logfile.seek(offset)
+                for rawLine in logfile:
+                    if not rawLine.endswith(b'\n'):
+                        break # rsync's still writing this one. Pick it up next time
+                    offset += len(rawLine)
+                    oneLine = rawLine.decode('utf-8', errors='replace')
                     index = oneLine.find('] Copied ')
                     if index > 0:
                         # Found a filename we've copied
                         index += 9 # Increment the index to strip the '] Copied ' prefix
-                        uploadedFile = '/' + (oneLine[index:]).strip()
+                        copiedName = oneLine[index:].strip()
+                        uploadedFile = '/' + copiedName.lstrip('/')
+                        if not os.path.isfile(uploadedFile):
+                            uploadedFile = os.path.join(PI_PHOTO_DIR, copiedName) # --files-from names are relative
                         if os.path.isfile(uploadedFile):
                             #log(f' === uploadedFile = {uploadedFile}')
                             # Helpfully, ".isfile" will be false if we've accidentally nominated a directory
-                            numFilesOK = uploadedOK(uploadedFile, numFilesOK)
-                    else:
-                        tempfile.write(oneLine)
-        try:
-            os.replace(RSYNC_TMP_FILE, RSYNC_LOG_FILE)
-        except Exception as e:
-            log(f'File replace exception: {e}')
-
+                            recordFileMetrics(uploadedFile, 'rsync', os.path.getsize(uploadedFile), None) # rsync doesn't time each file
+                            numFilesOK = uploadedOK(uploadedFile, numFilesOK, 'rsync')
+            if offset >= RSYNC_LOG_MAX and offset == os.path.getsize(RSYNC_LOG_FILE):
+                # We've read it all. Start it afresh so it doesn't grow forever
+                with open(RSYNC_LOG_FILE, 'w'):
+                    pass
+                offset = 0
+        with ledgerLock:
+            ledger.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rsyncLogOffset', ?)", (str(offset),))
+            ledger.commit()
     except Exception as e:
-        #log(f'Exception deleting {filename} from  {PI_THUMBS_INFO_FILE}')
         log(f'Exception: {e}')
 
     log(f'cleanupRsync - exited. numFilesOK =  {numFilesOK}')
     return numFilesOK
 
 
-def uploadedOK(filename, filecount):
+def uploadedOK(filename, filecount, destination, numBytes=None):
+    """
+    The file (or in the derivative tier, its low-res copy of numBytes) has been uploaded OK. Record it in the ledger.
+    Queue the local file, thumb, preview & metadata for deletion if required. That's only once the original's uploaded,
+    and with alsoTransferTo, only once every destination has it
+    """
+    global ledgerUncommitted, bytesUploaded
+    log(f' Uploaded {filename}' + (' (low-res)' if uploadTier == 'derivative' else ''))
+    try:
+        st = os.stat(filename)
+        if numBytes is None:
+            numBytes = st.st_size
+        with ledgerLock:
+            ledger.execute('INSERT OR REPLACE INTO uploads (path, destination, tier, size, mtime, uploaded) VALUES (?, ?, ?, ?, ?, ?)',
+                           (filename, destination, uploadTier, numBytes, st.st_mtime, time.time()))
+            ledgerUncommitted += 1
+            bytesUploaded += numBytes
+            if ledgerUncommitted >= LEDGER_COMMIT_EVERY:
+                ledger.commit()
+                ledgerUncommitted = 0
+    except Exception as e:
+        log(f'Error recording {filename} in the ledger: {e}')
+    recordManifest(filename, destination)
+    if deleteAfterTransfer and uploadTier == 'original' and uploadedEverywhere(filename):
+        with deletionLock:
+            pendingDeletions.append(filename)
+            flush = len(pendingDeletions) >= LEDGER_COMMIT_EVERY
+        if flush:
+            flushDeletions()
+    return (filecount + 1)
+
+
+def uploadedEverywhere(filename):
     """
-    The file has been uploaded OK. Add it to the UPLOADED_PHOTOS_LIST.
-    Delete local file, thumb, preview & metadata if required
+    True if the ledger has the original uploaded to every destination
     """
-    log(f' Uploaded {filename}')
-    if deleteAfterTransfer:
+    if len(destinations) < 2:
+        return True
+    try:
+        with ledgerLock:
+            for destination in destinations:
+                scope, params = ledgerScope(destination)
+                if not ledger.execute(f"SELECT 1 FROM uploads u WHERE u.path = ? AND u.tier = 'original' AND {scope}", (filename,) + params).fetchone():
+                    return False
+    except Exception as e:
+        log(f'Error checking the destinations of {filename}: {e}')
+        return False
+    return True
+
+
+def flushDeletions():
+    """
+    deleteAfterTransfer: deletes the images uploaded since the last flush, with their thumbs, previews & metadata.
+    The ledger is committed first, so an image is never deleted before its upload has been recorded, and the
+    thumbs info & photo manifest stores are updated once for the whole batch rather than once per image.
+    """
+    global pendingDeletions, ledgerUncommitted
+    with deletionLock: # Concurrent destinations mustn't both rewrite the thumbs info file
+        if not pendingDeletions:
+            return
         try:
-            os.remove(filename)
-            log(f'  Deleted {filename}')
-            deleteThumbsInfo(filename)
+            with ledgerLock:
+                ledger.commit()
+                ledgerUncommitted = 0
+        except Exception as e:
+            log(f'flushDeletions unable to commit the ledger. Nothing deleted: {e}')
+            return
+        deletedNames = set()
+        deletedPaths = set()
+        for filename in pendingDeletions:
+            try:
+                os.remove(filename)
+                log(f'  Deleted {filename}')
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                log(f'Unknown error deleting {filename}: {e}')
+                continue
+            deletedNames.add(os.path.basename(filename))
+            deletedPaths.add(makeShortPath('', filename))
             for folder,suffix in [(PI_THUMBS_DIR, '-thumb.JPG'), (PI_PREVIEW_DIR, '-preview.JPG')]:
                 try:
                     file2Delete = filename.replace( PI_PHOTO_DIR, folder)
@@ -856,34 +2378,94 @@ def uploadedOK(filename, filecount):
                         log(f'  Deleted {file2Delete}')
                 except Exception as e:
                     log(f'Error deleting file {file2Delete} : {e}')
+        pendingDeletions = []
+        deleteThumbsInfo(deletedNames)
+        deletePhotoManifest(deletedPaths)
+
+
+def deletePhotoManifest(shortPaths):
+    """
+    Delete the hashes of these images (by 'DCIM/...' path) from PI_PHOTO_MANIFEST_DB
+    """
+    if not shortPaths:
+        return
+    photoManifest = openPhotoManifest()
+    if photoManifest is None:
+        return
+    try:
+        with photoManifest:
+            numDeleted = photoManifest.executemany('DELETE FROM hashes WHERE path = ?', [(shortPath,) for shortPath in shortPaths]).rowcount
+        log(f'Deleted {numDeleted} entries from {PI_PHOTO_MANIFEST_DB}')
+    except Exception as e:
+        log(f'Exception deleting {len(shortPaths)} entries from {PI_PHOTO_MANIFEST_DB}')
+        log(f'Exception: {e}')
+    finally:
+        photoManifest.close()
+
+
+def deleteThumbsInfo(filenames):
+    """
+    Delete the metadata of these images (by filename, e.g. 'IMG_1234.JPG') from PI_THUMBS_INFO_DB, and from the legacy
+    PI_THUMBS_INFO_FILE if intvlm8r hasn't imported it yet. The store's never created here: we're often run with sudo
+    """
+    if not filenames:
+        return
+    if os.path.isfile(PI_THUMBS_INFO_DB):
+        try:
+            thumbsInfo = sqlite3.connect(f'file:{PI_THUMBS_INFO_DB}?mode=rw', uri=True, timeout=30)
+            with thumbsInfo:
+                numDeleted = thumbsInfo.executemany('DELETE FROM exif WHERE filename = ?', [(filename,) for filename in filenames]).rowcount
+            for sidecar in ('-wal', '-shm'):
+                if os.path.isfile(PI_THUMBS_INFO_DB + sidecar):
+                    chownToUser(PI_THUMBS_INFO_DB + sidecar) # In case they're ours. The web site needs to write to them too
+            thumbsInfo.close()
+            log(f'Deleted {numDeleted} entries from {PI_THUMBS_INFO_DB}')
         except Exception as e:
-            log(f'Unknown error in uploadedOK: {e}')
-    else:
-        with open(UPLOADED_PHOTOS_LIST, "a") as historyFile:
-            historyFile.write(filename + "\n")
-    return (filecount + 1)
+            log(f'Exception deleting {len(filenames)} entries from {PI_THUMBS_INFO_DB}')
+            log(f'Exception: {e}')
+    deleteLegacyThumbsInfo(filenames)
 
 
-# TY SO: https://stackoverflow.com/questions/4710067/using-python-for-deleting-a-specific-line-in-a-file
-def deleteThumbsInfo(filepath):
+def deleteLegacyThumbsInfo(filenames):
     """
-    Delete this file's metadata from PI_THUMBS_INFO_FILE
+    Each line of PI_THUMBS_INFO_FILE is 'filename = metadata', and only an exact match on the filename is removed.
+    The file is rewritten to a temp file that then replaces the original, so a crash can't leave it half-written
     """
+    if not os.path.isfile(PI_THUMBS_INFO_FILE):
+        return
+    tempName = PI_THUMBS_INFO_FILE + '.tmp'
     try:
-        filename = filepath.rsplit('/',1)[1]
-        with open(PI_THUMBS_INFO_FILE, "r") as f:
-            lines = f.readlines()
-        with open(PI_THUMBS_INFO_FILE, "w") as f:
-            for line in lines:
-                if filename not in line.strip("\n"):
-                    f.write(line)
+        st = os.stat(PI_THUMBS_INFO_FILE)
+        numDeleted = 0
+        with open(PI_THUMBS_INFO_FILE, "r") as f, open(tempName, "w") as tempfile:
+            for line in f:
+                if line.split(' = ', 1)[0] in filenames:
+                    numDeleted += 1
+                else:
+                    tempfile.write(line)
+        try:
+            # We're often run with sudo. Keep the file writable by the web site
+            os.chown(tempName, st.st_uid, st.st_gid)
+            os.chmod(tempName, st.st_mode)
+        except PermissionError:
+            pass
+        os.replace(tempName, PI_THUMBS_INFO_FILE)
+        log(f'Deleted {numDeleted} entries from {PI_THUMBS_INFO_FILE}')
     except Exception as e:
-        log(f'Exception deleting {filename} from  {PI_THUMBS_INFO_FILE}')
+        log(f'Exception deleting {len(filenames)} entries from {PI_THUMBS_INFO_FILE}')
         log(f'Exception: {e}')
     return
 
 
 def log(message):
+    global lastStatus
+    if message.startswith('STATUS: '):
+        destination = getattr(current, 'destination', None)
+        if destination is not None:
+            # One of several concurrent destinations. replicate() gathers them all up for the closing STATUS
+            destinationStatus[destination] = message[8:]
+            message = f'STATUS: {destination}: {message[8:]}'
+        lastStatus = message[8:]
     try:
         logging.info(message)
     except Exception as e:
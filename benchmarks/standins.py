@@ -0,0 +1,486 @@
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+# This script is part of the Intervalometerator project, a time-lapse camera controller for DSLRs:
+# https://github.com/greiginsydney/Intervalometerator
+#
+# Local stand-ins for the servers piTransfer.py uploads to, for transferBench.py:
+# - an FTP server (pyftpdlib)
+# - an SFTP server (paramiko)
+# - a fake of the parts of the Dropbox & Google Drive APIs that piTransfer uses
+# - a TCP relay that adds latency, loss & a bandwidth limit in front of any of them
+
+
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import datetime
+import json
+import logging
+import os
+import queue
+import random
+import re
+import socket
+import ssl
+import subprocess
+import threading
+import time
+
+
+def startThread(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+# ////////////////////////////////
+# ///////// LINK EMULATOR ////////
+# ////////////////////////////////
+
+class LinkEmulator:
+    """
+    Listens on a local port and relays each connection to targetPort, delaying everything by latency (ms, each way)
+    and limiting it to bandwidth (KB/s, each way, 0 = unlimited). 'loss' is the percentage of chunks that are held
+    back for a retransmission timeout, which is how packet loss looks from above TCP: a stall, not missing data.
+    """
+    RTO = 0.2 # Seconds. Linux's minimum TCP retransmission timeout
+
+    def __init__(self, targetPort, latency=0, loss=0, bandwidth=0):
+        self.targetPort = targetPort
+        self.latency = latency / 1000
+        self.loss = loss / 100
+        self.bandwidth = bandwidth * 1024
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        startThread(self.accept)
+
+    def accept(self):
+        while True:
+            client, _ = self.listener.accept()
+            try:
+                server = socket.create_connection(('127.0.0.1', self.targetPort))
+            except OSError:
+                client.close()
+                continue
+            for source, dest in ((client, server), (server, client)):
+                pipe = queue.Queue()
+                startThread(self.read, source, pipe)
+                startThread(self.write, dest, pipe)
+
+    def read(self, source, pipe):
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b''
+            pipe.put((time.monotonic() + self.latency, data))
+            if not data:
+                return
+
+    def write(self, dest, pipe):
+        while True:
+            due, data = pipe.get()
+            if self.loss and random.random() < self.loss:
+                due += self.RTO + 2 * self.latency
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if not data:
+                try:
+                    dest.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+                return
+            try:
+                dest.sendall(data)
+            except OSError:
+                return
+            if self.bandwidth:
+                time.sleep(len(data) / self.bandwidth)
+
+
+def netemStart(latency, loss, bandwidth):
+    """
+    The alternative to LinkEmulator: shape the loopback interface itself, so every connection (FTP data, ssh for
+    rsync) is affected. Needs root and the 'tc' command. Returns False if it couldn't be applied.
+    """
+    cmd = ['tc', 'qdisc', 'add', 'dev', 'lo', 'root', 'netem', 'delay', f'{latency}ms', 'loss', f'{loss}%']
+    if bandwidth:
+        cmd += ['rate', f'{bandwidth * 8}kbit']
+    try:
+        return subprocess.run(cmd, capture_output=True).returncode == 0
+    except FileNotFoundError:
+        return False
+
+
+def netemStop():
+    subprocess.run(['tc', 'qdisc', 'del', 'dev', 'lo', 'root'], capture_output=True)
+
+
+# ////////////////////////////////
+# ////////////// FTP /////////////
+# ////////////////////////////////
+
+def startFtpServer(rootFolder, user, password):
+    """
+    Returns the port of a pyftpdlib server with the one user, whose home is rootFolder
+    """
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.log import config_logging
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(user, password, rootFolder, perm='elradfmwMT')
+    handler = type('BenchFTPHandler', (FTPHandler,), {'authorizer': authorizer})
+    config_logging(level=logging.WARNING)
+    server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+    startThread(server.serve_forever)
+    return server.address[1]
+
+
+# ////////////////////////////////
+# ///////////// SFTP /////////////
+# ////////////////////////////////
+
+def startSftpServer(rootFolder, user, password):
+    """
+    Returns the port of a paramiko SFTP server that accepts user/password, and serves rootFolder as '/'
+    """
+    import paramiko
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL) # A client hanging up is reported as an error
+
+    class Server(paramiko.ServerInterface):
+        def check_auth_password(self, username, passwd):
+            if (username, passwd) == (user, password):
+                return paramiko.AUTH_SUCCESSFUL
+            return paramiko.AUTH_FAILED
+
+        def get_allowed_auths(self, username):
+            return 'password'
+
+        def check_channel_request(self, kind, chanid):
+            return paramiko.OPEN_SUCCEEDED
+
+    class Handle(paramiko.SFTPHandle):
+        def stat(self):
+            try:
+                return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        def chattr(self, attr):
+            return paramiko.SFTP_OK
+
+    class LocalSFTPServer(paramiko.SFTPServerInterface):
+        def local(self, path):
+            return os.path.join(rootFolder, self.canonicalize(path).lstrip('/'))
+
+        def list_folder(self, path):
+            try:
+                folder = self.local(path)
+                return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(folder, name)), name) for name in os.listdir(folder)]
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        def stat(self, path):
+            try:
+                return paramiko.SFTPAttributes.from_stat(os.stat(self.local(path)))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        lstat = stat
+
+        def open(self, path, flags, attr):
+            try:
+                fd = os.open(self.local(path), flags, 0o644)
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            if flags & os.O_WRONLY:
+                mode = 'ab' if flags & os.O_APPEND else 'wb'
+            elif flags & os.O_RDWR:
+                mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+            else:
+                mode = 'rb'
+            handle = Handle(flags)
+            handle.readfile = handle.writefile = os.fdopen(fd, mode)
+            return handle
+
+        def remove(self, path):
+            try:
+                os.remove(self.local(path))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        def rename(self, oldpath, newpath):
+            try:
+                os.rename(self.local(oldpath), self.local(newpath))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        def mkdir(self, path, attr):
+            try:
+                os.mkdir(self.local(path))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        def rmdir(self, path):
+            try:
+                os.rmdir(self.local(path))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        def chattr(self, path, attr):
+            return paramiko.SFTP_OK
+
+    hostKey = paramiko.RSAKey.generate(2048)
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def serve(client):
+        transport = paramiko.Transport(client)
+        transport.add_server_key(hostKey)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSFTPServer)
+        transport.start_server(server=Server())
+
+    def accept():
+        while True:
+            client, _ = listener.accept()
+            startThread(serve, client)
+
+    startThread(accept)
+    return listener.getsockname()[1]
+
+
+# ////////////////////////////////
+# ////////// FAKE CLOUDS /////////
+# ////////////////////////////////
+
+class FakeCloud:
+    """
+    The state behind the fake Dropbox & Google Drive APIs: uploaded files are counted and sized, not kept (other than
+    piTransfer's small manifests, which are read back)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nextId = 1
+        self.sessions = {}    # Upload session/id: bytes received
+        self.files = {}       # Dropbox path, or Google id: (title, parentId, size, content or None)
+        self.filesUploaded = 0
+        self.bytesUploaded = 0
+
+    def newId(self):
+        with self.lock:
+            self.nextId += 1
+            return f'{self.nextId:016x}'
+
+    def store(self, key, title, parentId, data, size=None):
+        size = len(data) if size is None else size
+        with self.lock:
+            self.files[key] = (title, parentId, size, data if title.endswith('.txt') else None)
+            self.filesUploaded += 1
+            self.bytesUploaded += size
+
+
+class CloudHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    cloud = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def reply(self, status, payload=b'', contentType='application/json', headers=None):
+        if isinstance(payload, (dict, list)):
+            payload = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class DropboxHandler(CloudHandler):
+    """
+    Just enough of the Dropbox v2 API for commenceDbx(): token refresh, the account check, upload sessions, batch
+    commits, and the manifests' download & upload
+    """
+    def do_POST(self):
+        path = urlparse(self.path).path
+        data = self.body()
+        # Content endpoints take their argument in a header, RPC endpoints in the body:
+        header = self.headers.get('Dropbox-API-Arg')
+        arg = (json.loads(header) if header else (json.loads(data) if path.startswith('/2/') and data else None)) or {}
+        if path == '/oauth2/token':
+            return self.reply(200, {'access_token': 'bench', 'expires_in': 14400, 'token_type': 'bearer'})
+        if path == '/2/users/get_current_account':
+            return self.reply(200, self.account())
+        if path == '/2/files/upload_session/start':
+            sessionId = self.cloud.newId()
+            self.cloud.sessions[sessionId] = len(data)
+            return self.reply(200, {'session_id': sessionId})
+        if path == '/2/files/upload_session/append_v2':
+            cursor = arg['cursor']
+            received = self.cloud.sessions.get(cursor['session_id'])
+            if received is None:
+                return self.error('lookup_failed/not_found/', {'.tag': 'not_found'})
+            if received != cursor['offset']:
+                return self.error('incorrect_offset/', {'.tag': 'incorrect_offset', 'correct_offset': received})
+            self.cloud.sessions[cursor['session_id']] = received + len(data)
+            return self.reply(200, b'null')
+        if path == '/2/files/upload_session/finish_batch_v2':
+            entries = []
+            for entry in arg['entries']:
+                size = self.cloud.sessions.pop(entry['cursor']['session_id'], 0)
+                self.cloud.store(entry['commit']['path'], os.path.basename(entry['commit']['path']), None, b'', size)
+                entries.append(dict(self.metadata(entry['commit']['path'], size), **{'.tag': 'success'}))
+            return self.reply(200, {'entries': entries})
+        if path == '/2/files/upload':
+            self.cloud.store(arg['path'], os.path.basename(arg['path']), None, data)
+            return self.reply(200, self.metadata(arg['path'], len(data)))
+        if path == '/2/files/download':
+            stored = self.cloud.files.get(arg['path'])
+            if stored is None:
+                return self.error('path/not_found/', {'.tag': 'path', 'path': {'.tag': 'not_found'}})
+            return self.reply(200, stored[3] or b'', 'application/octet-stream',
+                              {'Dropbox-API-Result': json.dumps(self.metadata(arg['path'], stored[2]))})
+        self.reply(404, {'error_summary': 'not_found/'})
+
+    def error(self, summary, error):
+        self.reply(409, {'error_summary': summary, 'error': error})
+
+    def metadata(self, path, size):
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        return {'.tag': 'file', 'name': os.path.basename(path), 'id': 'id:' + self.cloud.newId(), 'client_modified': now,
+                'server_modified': now, 'rev': '0123456789abcdef', 'size': size, 'path_lower': path.lower(), 'path_display': path}
+
+    def account(self):
+        return {'account_id': 'dbid:' + 'A' * 35, 'name': {'given_name': 'Bench', 'surname': 'Mark', 'familiar_name': 'Bench',
+                'display_name': 'Bench Mark', 'abbreviated_name': 'BM'}, 'email': 'bench@example.com', 'email_verified': True,
+                'disabled': False, 'locale': 'en', 'referral_link': 'https://example.com', 'is_paired': False,
+                'account_type': {'.tag': 'basic'}, 'root_info': {'.tag': 'user', 'root_namespace_id': '1', 'home_namespace_id': '1'}}
+
+
+class DriveHandler(CloudHandler):
+    """
+    Just enough of the Google Drive v2 API for commenceGoogle(): folder queries & creation, resumable uploads, and
+    the manifests' download & upload
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/drive/v2/files':
+            q = query.get('q', [''])[0]
+            title = re.search(r"title='((?:[^'\\]|\\.)*)'", q)
+            parent = re.search(r"'([^']*)' in parents", q)
+            wantFolders = "mimeType contains 'application/vnd.google-apps.folder'" in q
+            items = []
+            for fileId, (fileTitle, parentId, size, content) in list(self.cloud.files.items()):
+                if title and fileTitle != title.group(1).replace("\\'", "'"):
+                    continue
+                if parent and parentId != parent.group(1):
+                    continue
+                if wantFolders != (size is None):
+                    continue
+                items.append({'id': fileId, 'title': fileTitle})
+            return self.reply(200, {'items': items})
+        match = re.match(r'/drive/v2/files/([^/]+)$', url.path)
+        if match and query.get('alt') == ['media'] and match.group(1) in self.cloud.files:
+            return self.reply(200, self.cloud.files[match.group(1)][3] or b'', 'application/octet-stream')
+        self.reply(404, {'error': {'code': 404, 'message': 'File not found'}})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        data = self.body()
+        if url.path == '/drive/v2/files':
+            # A new folder
+            body = json.loads(data)
+            fileId = self.cloud.newId()
+            with self.cloud.lock:
+                self.cloud.files[fileId] = (body['title'], (body.get('parents') or [{}])[0].get('id'), None, None)
+            return self.reply(200, {'id': fileId, 'title': body['title']})
+        if url.path == '/upload/drive/v2/files' and query.get('uploadType') == ['resumable']:
+            sessionId = self.cloud.newId()
+            self.cloud.sessions[sessionId] = (json.loads(data or b'{}'), bytearray())
+            location = f'https://{self.headers["Host"]}/upload/drive/v2/files?uploadType=resumable&upload_id={sessionId}'
+            return self.reply(200, b'', headers={'Location': location})
+        if url.path == '/upload/drive/v2/files' and query.get('uploadType') == ['multipart']:
+            message = BytesParser().parsebytes(b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + data)
+            parts = message.get_payload()
+            body = json.loads(parts[0].get_payload(decode=True))
+            fileId = self.cloud.newId()
+            self.cloud.store(fileId, body['title'], (body.get('parents') or [{}])[0].get('id'), parts[1].get_payload(decode=True))
+            return self.reply(200, {'id': fileId, 'title': body['title']})
+        self.reply(404, {'error': {'code': 404, 'message': 'Not found'}})
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        data = self.body()
+        sessionId = query.get('upload_id', [None])[0]
+        if sessionId is not None:
+            if sessionId not in self.cloud.sessions:
+                return self.reply(404, {'error': {'code': 404, 'message': 'Session not found'}})
+            body, received = self.cloud.sessions[sessionId]
+            total = re.match(r'bytes (?:\d+-\d+|\*)/(\d+|\*)', self.headers.get('Content-Range', 'bytes */*')).group(1)
+            received.extend(data)
+            if total != '*' and len(received) >= int(total):
+                del self.cloud.sessions[sessionId]
+                fileId = self.cloud.newId()
+                self.cloud.store(fileId, body.get('title', ''), (body.get('parents') or [{}])[0].get('id'), bytes(received))
+                return self.reply(200, {'id': fileId, 'title': body.get('title', '')})
+            headers = {'Range': f'bytes=0-{len(received) - 1}'} if received else {}
+            return self.reply(308, b'', headers=headers)
+        match = re.match(r'/upload/drive/v2/files/([^/]+)$', url.path)
+        if match and match.group(1) in self.cloud.files:
+            title, parentId, size, content = self.cloud.files[match.group(1)]
+            self.cloud.store(match.group(1), title, parentId, data)
+            return self.reply(200, {'id': match.group(1), 'title': title})
+        self.reply(404, {'error': {'code': 404, 'message': 'Not found'}})
+
+
+def startCloudServer(handler, certFile):
+    """
+    Returns the port of a fake cloud API (DropboxHandler or DriveHandler), and its FakeCloud. Both SDKs only talk
+    https, so it needs a certFile (see makeCertificate)
+    """
+    cloud = FakeCloud()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), type(handler.__name__, (handler,), {'cloud': cloud}))
+    server.daemon_threads = True
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certFile)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    startThread(server.serve_forever)
+    return server.server_address[1], cloud
+
+
+def makeCertificate(folder):
+    """
+    Makes a self-signed certificate (& key) for 'localhost' with openssl, and returns its path
+    """
+    certFile = os.path.join(folder, 'localhost.pem')
+    if not os.path.isfile(certFile):
+        keyFile = os.path.join(folder, 'localhost.key')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '30', '-subj', '/CN=localhost',
+                        '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1', '-keyout', keyFile, '-out', certFile + '.tmp'],
+                       check=True, capture_output=True)
+        with open(certFile, 'w') as f:
+            f.write(open(certFile + '.tmp').read() + open(keyFile).read())
+        os.remove(certFile + '.tmp')
+    return certFile
@@ -0,0 +1,252 @@
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+# This script is part of the Intervalometerator project, a time-lapse camera controller for DSLRs:
+# https://github.com/greiginsydney/Intervalometerator
+#
+# Benchmarks the way makeThumb() makes its thumbnails against a full decode of each image, comparing the time
+# and peak memory per thumbnail. See README.md in this folder.
+
+
+import argparse
+import ast
+import datetime
+import io
+import json
+import os
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ExifTags
+
+METHODS = ('full', 'thumbnail', 'makeThumb')
+INTVLM8R = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Raspberry Pi', 'www', 'intvlm8r.py.new')
+THUMB_SIZE = (160, 160) # As makeThumb() makes them
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark makeThumb()'s thumbnails against a full decode of each image")
+    parser.add_argument('--methods', default='full,thumbnail,makeThumb', help=f"Comma-separated. Any of: {', '.join(METHODS)}")
+    parser.add_argument('--megapixels', default='24,45', help='Comma-separated sizes of the synthetic images')
+    parser.add_argument('--count', type=int, default=3, help='Synthetic images of each size & kind')
+    parser.add_argument('--images', help="A folder of real JPGs to use instead of the synthetic ones")
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'intvlm8r-thumbbench'), help='Where the images & thumbnails go')
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--worker', nargs=3, metavar=('METHOD', 'IMAGES', 'RESULT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return runWorker(*args.worker)
+
+    os.makedirs(args.workdir, exist_ok=True)
+    if args.images:
+        imageSets = {'real': sorted(os.path.join(args.images, name) for name in os.listdir(args.images) if name.upper().endswith('.JPG'))}
+    else:
+        imageSets = {}
+        for megapixels in [int(n) for n in args.megapixels.split(',')]:
+            for embedded in (False, True):
+                name = f"{megapixels}MP{' +EXIF thumb' if embedded else ''}"
+                imageSets[name] = makeImages(args.workdir, megapixels, embedded, args.count)
+    saveThumbFile = extractSaveThumb(args.workdir)
+    results = []
+    for name, images in imageSets.items():
+        if not images:
+            print(f'No JPGs in {args.images}')
+            return 1
+        for method in args.methods.split(','):
+            result = runMethod(method.strip(), name, images, args.workdir)
+            if result:
+                results.append(result)
+                printResult(result, len(results) == 1)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'when': datetime.datetime.now().isoformat(timespec='seconds'), 'args': vars(args), 'results': results}, f, indent=2)
+    return 0
+
+
+def makeImages(workdir, megapixels, embedded, count):
+    """
+    Returns the paths of count 3:2 JPGs of the given size, made the first time they're asked for. Noise makes them
+    roughly as hard to decode as a real photo. If embedded, each carries a 160x107 EXIF thumbnail, as a camera's would
+    """
+    width = int((megapixels * 10**6 * 1.5) ** 0.5)
+    height = width * 2 // 3
+    folder = os.path.join(workdir, f"{megapixels}MP{'-exif' if embedded else ''}")
+    marker = folder + '.complete'
+    images = [os.path.join(folder, f'IMG_{index:04d}.JPG') for index in range(count)]
+    if os.path.isfile(marker) and all(os.path.isfile(image) for image in images):
+        return images
+    print(f'Making {count} x {width}x{height} images in {folder}')
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    for index, filename in enumerate(images):
+        noise = Image.effect_noise((width, height), 24 + index)
+        gradient = Image.linear_gradient('L').resize((width, height))
+        image = Image.merge('RGB', (noise, gradient, Image.blend(noise, gradient, 0.5)))
+        exif = b''
+        if embedded:
+            thumb = image.copy()
+            thumb.thumbnail(THUMB_SIZE)
+            thumbData = io.BytesIO()
+            thumb.save(thumbData, 'JPEG')
+            exif = exifWithThumbnail(thumbData.getvalue())
+        image.save(filename, 'JPEG', quality=90, exif=exif)
+    open(marker, 'w').close()
+    return images
+
+
+def exifWithThumbnail(thumbData):
+    """
+    Returns an APP1 EXIF block holding just a thumbnail: a little-endian TIFF header, an empty IFD0, then an IFD1
+    with the thumbnail's offset & length, followed by the thumbnail itself
+    """
+    ifd0 = struct.pack('<HI', 0, 14)                      # No entries, IFD1 follows at 8 + 6
+    ifd1 = struct.pack('<H', 2)
+    ifd1 += struct.pack('<HHII', 0x0201, 4, 1, 14 + 30)   # JPEGInterchangeFormat, after this 30-byte IFD
+    ifd1 += struct.pack('<HHII', 0x0202, 4, 1, len(thumbData))
+    ifd1 += struct.pack('<I', 0)
+    return b'Exif\x00\x00' + b'II*\x00' + struct.pack('<I', 8) + ifd0 + ifd1 + thumbData
+
+
+def runMethod(method, name, images, workdir):
+    """
+    Runs the method in a worker process, so its peak RSS is the thumbnails' alone
+    """
+    if method not in METHODS:
+        print(f'Unknown method {method}')
+        return None
+    resultFile = os.path.join(workdir, 'result.json')
+    if os.path.isfile(resultFile):
+        os.remove(resultFile)
+    worker = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', method, json.dumps(images), resultFile],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf-8')
+    if worker.returncode != 0 or not os.path.isfile(resultFile):
+        print(f'{method} worker failed ({worker.returncode}): {worker.stderr.strip()[-2000:]}')
+        return None
+    with open(resultFile) as f:
+        result = json.load(f)
+    result.update({'method': method, 'images': name, 'MB': sum(os.path.getsize(image) for image in images) / len(images) / 2**20})
+    return result
+
+
+def extractSaveThumb(workdir):
+    """
+    intvlm8r.py needs Flask, Celery, gphoto2 & more, so only makeThumb()'s saveThumb() is copied out of it, to a
+    file of its own. (Parsing all of intvlm8r.py in the worker would inflate its peak RSS)
+    """
+    with open(INTVLM8R) as f:
+        source = f.read()
+    function = next(node for node in ast.parse(source).body if isinstance(node, ast.FunctionDef) and node.name == 'saveThumb')
+    saveThumbFile = os.path.join(workdir, 'saveThumb.py')
+    with open(saveThumbFile, 'w') as f:
+        f.write(ast.get_source_segment(source, function) + '\n')
+    return saveThumbFile
+
+
+def loadSaveThumb(saveThumbFile):
+    namespace = {'Image': Image, 'ExifTags': ExifTags, 'io': io}
+    with open(saveThumbFile) as f:
+        exec(compile(f.read(), saveThumbFile, 'exec'), namespace)
+    return namespace['saveThumb']
+
+
+def fullThumb(imageFile, dest, size):
+    """
+    Decodes the whole image before the resize: what a thumbnail costs without draft mode or an EXIF thumbnail
+    """
+    with Image.open(imageFile) as image:
+        image.load()
+        image.thumbnail(size, Image.Resampling.LANCZOS, reducing_gap=None)
+        image.save(dest, 'JPEG')
+    return 'full decode'
+
+
+def plainThumb(imageFile, dest, size):
+    """
+    How makeThumb() made them before saveThumb(). PIL's thumbnail() puts a JPEG in draft mode itself (reducing_gap)
+    """
+    with Image.open(imageFile) as image:
+        image.thumbnail(size, Image.Resampling.LANCZOS)
+        image.save(dest, 'JPEG')
+    return 'thumbnail()'
+
+
+def resetPeakRss():
+    """
+    A child inherits its parent's peak RSS through the exec (and the parent's made some big images), so it's reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peakRss():
+    """
+    Returns the peak RSS in MB: VmHWM, which resetPeakRss() can reset, or ru_maxrss where there's no /proc
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def runWorker(method, imagesJson, resultFile):
+    images = json.loads(imagesJson)
+    if method == 'makeThumb':
+        makeThumb = loadSaveThumb(os.path.join(os.path.dirname(resultFile), 'saveThumb.py'))
+    elif method == 'thumbnail':
+        makeThumb = plainThumb
+    else:
+        makeThumb = fullThumb
+    resetPeakRss()
+    baseRss = peakRss()
+    dest = os.path.join(os.path.dirname(resultFile), 'thumb.JPG')
+    times = []
+    sources = set()
+    for image in images:
+        started = time.perf_counter()
+        sources.add(makeThumb(image, dest, THUMB_SIZE))
+        times.append(time.perf_counter() - started)
+    thumbPeakRss = peakRss()
+    with Image.open(dest) as thumb:
+        thumbSize = thumb.size
+    result = {
+        'thumbs': len(images),
+        'msPerThumb': sum(times) / len(times) * 1000,
+        'slowestMs': max(times) * 1000,
+        'peakRssMB': thumbPeakRss,
+        'thumbRssMB': thumbPeakRss - baseRss,
+        'thumbSize': thumbSize,
+        'source': ', '.join(sorted(sources)),
+    }
+    with open(resultFile, 'w') as f:
+        json.dump(result, f)
+    return 0
+
+
+def printResult(result, header):
+    if header:
+        print(f"{'images':18} {'MB':>5} {'method':10} {'ms/thumb':>9} {'slowest':>8} {'RSS MB':>7} {'+MB':>7}  source")
+    print(f"{result['images']:18} {result['MB']:5.1f} {result['method']:10} {result['msPerThumb']:9.1f} {result['slowestMs']:8.1f} "
+          f"{result['peakRssMB']:7.1f} {result['thumbRssMB']:7.1f}  {result['source']}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
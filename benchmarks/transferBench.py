@@ -0,0 +1,258 @@
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+# This script is part of the Intervalometerator project, a time-lapse camera controller for DSLRs:
+# https://github.com/greiginsydney/Intervalometerator
+#
+# Benchmarks piTransfer.py's upload backends against local stand-in servers (see standins.py), so a change can be
+# measured before it goes anywhere near a Pi. See README.md in this folder.
+
+
+import argparse
+import datetime
+import getpass
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import standins
+
+BACKENDS = ('ftp', 'sftp', 'rsync', 'dropbox', 'google')
+PI_TRANSFER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Raspberry Pi', 'www')
+FILES_PER_FOLDER = 500 # Cameras start a new DCIM folder every so often. (Canon's limit is 9999)
+USER = 'bench'
+PASSWORD = 'bench'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the piTransfer.py upload backends against local stand-in servers')
+    parser.add_argument('--backends', default='ftp,sftp,dropbox,google', help=f"Comma-separated. Any of: {', '.join(BACKENDS)}")
+    parser.add_argument('--trees', default='1000,10000', help='Comma-separated file counts. e.g. 1000,10000,100000')
+    parser.add_argument('--file-kb', type=int, default=16, help='The size of each synthetic image (KB)')
+    parser.add_argument('--concurrency', type=int, default=1, help='FTP & SFTP upload workers')
+    parser.add_argument('--latency', type=int, default=0, help='Milliseconds added each way')
+    parser.add_argument('--loss', type=float, default=0, help='Percentage of packets lost')
+    parser.add_argument('--bandwidth', type=int, default=0, help='KB/s each way. 0 = unlimited')
+    parser.add_argument('--netem', action='store_true', help="Shape the loopback interface with 'tc netem' (root only) instead of the relay")
+    parser.add_argument('--cellular', action='store_true', help='Shorthand for --latency 60 --loss 1 --bandwidth 250')
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'intvlm8r-bench'), help='Where the trees & runs go')
+    parser.add_argument('--keep', action='store_true', help="Don't delete each run's uploaded files & ledger")
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--worker', nargs=3, metavar=('BACKEND', 'HOME', 'CONFIG'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return runWorker(*args.worker)
+    if args.cellular:
+        args.latency, args.loss, args.bandwidth = 60, 1, 250
+
+    os.makedirs(args.workdir, exist_ok=True)
+    shaping = args.latency or args.loss or args.bandwidth
+    if args.netem and shaping:
+        if not standins.netemStart(args.latency, args.loss, args.bandwidth):
+            print("Unable to apply 'tc netem' to lo. (Are you root?)")
+            return 1
+    results = []
+    try:
+        for numFiles in [int(n) for n in args.trees.split(',')]:
+            tree = makeTree(args.workdir, numFiles, args.file_kb)
+            for backend in args.backends.split(','):
+                result = runBackend(backend.strip().lower(), tree, numFiles, args, shaping and not args.netem)
+                if result:
+                    results.append(result)
+                    printResult(result, len(results) == 1)
+    finally:
+        if args.netem and shaping:
+            standins.netemStop()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'when': datetime.datetime.now().isoformat(timespec='seconds'), 'args': vars(args), 'results': results}, f, indent=2)
+    return 0
+
+
+def makeTree(workdir, numFiles, fileKB):
+    """
+    Returns the path of a synthetic photos/ tree of numFiles images in folders of FILES_PER_FOLDER, made the first
+    time it's asked for. Each image is unique, so neither rsync nor the manifests can dedupe them
+    """
+    tree = os.path.join(workdir, f'tree-{numFiles}x{fileKB}KB')
+    marker = tree + '.complete'
+    if os.path.isfile(marker):
+        return tree
+    print(f'Making a tree of {numFiles} x {fileKB}KB files in {tree}')
+    shutil.rmtree(tree, ignore_errors=True)
+    os.makedirs(tree)
+    pool = os.urandom(2**20 + fileKB * 1024)
+    mtime = time.time() - numFiles * 60
+    for index in range(numFiles):
+        folder = os.path.join(tree, 'DCIM', f'{100 + index // FILES_PER_FOLDER}CANON')
+        if index % FILES_PER_FOLDER == 0:
+            os.makedirs(folder)
+        filename = os.path.join(folder, f'IMG_{index % 10000:04d}.JPG')
+        offset = (index * 7919) % 2**20
+        with open(filename, 'wb') as f:
+            f.write(index.to_bytes(8, 'big') + pool[offset:offset + fileKB * 1024 - 8])
+        os.utime(filename, (mtime + index * 60, mtime + index * 60)) # One a minute, like a time-lapse
+    for folder in os.listdir(os.path.join(tree, 'DCIM')):
+        os.utime(os.path.join(tree, 'DCIM', folder), (mtime, mtime))
+    open(marker, 'w').close()
+    return tree
+
+
+def runBackend(backend, tree, numFiles, args, relay):
+    """
+    Starts the backend's stand-in, then runs the upload in a worker process so its peak RSS is piTransfer's alone
+    """
+    if backend not in BACKENDS:
+        print(f'Unknown backend {backend}')
+        return None
+    runHome = os.path.join(args.workdir, f'run-{backend}-{numFiles}')
+    shutil.rmtree(runHome, ignore_errors=True)
+    remoteRoot = os.path.join(runHome, 'remote')
+    for folder in ('www/static', '.ssh', 'thumbs', 'preview'):
+        os.makedirs(os.path.join(runHome, folder))
+    os.makedirs(remoteRoot)
+    os.symlink(tree, os.path.join(runHome, 'photos'))
+    config = {'backend': backend, 'numFiles': numFiles, 'concurrency': args.concurrency, 'remoteFolder': 'photos'}
+    env = dict(os.environ, HOME=runHome)
+    env.pop('SUDO_USER', None)
+
+    try:
+        if backend == 'ftp':
+            port = standins.startFtpServer(remoteRoot, USER, PASSWORD)
+        elif backend == 'sftp':
+            port = standins.startSftpServer(remoteRoot, USER, PASSWORD)
+            config['remoteFolder'] = '/photos'
+        elif backend == 'rsync':
+            if subprocess.run(['ssh', '-o', 'BatchMode=yes', '-o', 'StrictHostKeyChecking=accept-new', 'localhost', 'true'],
+                              capture_output=True).returncode != 0 or not os.path.isfile('/usr/bin/rsync'):
+                print('Skipping rsync: it needs /usr/bin/rsync, and key-based ssh to localhost for this user')
+                return None
+            port = None
+            config['remoteFolder'] = remoteRoot
+            config['user'] = getpass.getuser()
+        elif backend == 'dropbox':
+            certFile = standins.makeCertificate(args.workdir)
+            port, cloud = standins.startCloudServer(standins.DropboxHandler, certFile)
+            env['REQUESTS_CA_BUNDLE'] = certFile
+        elif backend == 'google':
+            certFile = standins.makeCertificate(args.workdir)
+            port, cloud = standins.startCloudServer(standins.DriveHandler, certFile)
+            env['HTTPLIB2_CA_CERTS'] = certFile
+    except ImportError as e:
+        print(f'Skipping {backend}: {e}')
+        return None
+    if port and relay:
+        port = standins.LinkEmulator(port, args.latency, args.loss, args.bandwidth).port
+    config['port'] = port
+    if backend == 'dropbox':
+        env['DROPBOX_API_HOST'] = env['DROPBOX_API_CONTENT_HOST'] = f'localhost:{port}'
+
+    resultFile = os.path.join(runHome, 'result.json')
+    config['resultFile'] = resultFile
+    started = time.time()
+    worker = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', backend, runHome, json.dumps(config)],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf-8')
+    if worker.returncode != 0 or not os.path.isfile(resultFile):
+        print(f'{backend} worker failed ({worker.returncode}): {worker.stderr.strip()[-2000:]}')
+        return None
+    with open(resultFile) as f:
+        result = json.load(f)
+    result.update({'backend': backend, 'tree': numFiles, 'fileKB': args.file_kb, 'concurrency': args.concurrency,
+                   'latency': args.latency, 'loss': args.loss, 'bandwidth': args.bandwidth, 'wall': time.time() - started})
+    if not args.keep:
+        shutil.rmtree(runHome, ignore_errors=True)
+    return result
+
+
+def runWorker(backend, runHome, configJson):
+    """
+    Runs in its own process, with HOME pointing at the run's folder so piTransfer's ledger, log etc all land there
+    """
+    config = json.loads(configJson)
+    sys.path.insert(0, os.path.abspath(PI_TRANSFER_DIR))
+    import logging
+    import piTransfer
+
+    logging.basicConfig(filename=piTransfer.LOGFILE_NAME, filemode='a', format='{asctime} {message}', style='{', level=logging.DEBUG)
+    piTransfer.deleteAfterTransfer = False
+    listTimes = []
+    listNewImages = piTransfer.list_New_Images
+
+    def timedListNewImages(*args, **kwargs):
+        started = time.perf_counter()
+        newFiles = listNewImages(*args, **kwargs)
+        listTimes.append(time.perf_counter() - started)
+        return newFiles
+
+    piTransfer.list_New_Images = timedListNewImages
+    server = f"localhost:{config['port']}"
+    if not piTransfer.openLedger():
+        return 1
+    started = time.perf_counter()
+    if backend == 'ftp':
+        piTransfer.commenceFtp(server, USER, PASSWORD, config['remoteFolder'], config['concurrency'])
+    elif backend == 'sftp':
+        piTransfer.commenceSftp(server, USER, PASSWORD, config['remoteFolder'], config['concurrency'])
+    elif backend == 'rsync':
+        piTransfer.commenceRsync(config['user'], 'localhost', config['remoteFolder'])
+    elif backend == 'dropbox':
+        with open(piTransfer.DROPBOX_TOKEN, 'w') as f:
+            f.write('bench-refresh-token')
+        piTransfer.commenceDbx('bench-app-key')
+    elif backend == 'google':
+        from oauth2client.client import OAuth2Credentials
+        credentials = OAuth2Credentials('bench', 'bench', 'bench', 'bench', datetime.datetime.utcnow() + datetime.timedelta(days=1),
+                                        'http://localhost/token', 'intvlm8r-bench')
+        piTransfer.Storage(piTransfer.GOOGLE_CREDENTIALS).put(credentials)
+        build = piTransfer.discovery.build
+        piTransfer.discovery.build = lambda *args, **kwargs: build(*args, client_options={'api_endpoint': f'https://{server}/drive/v2/'}, **kwargs)
+        piTransfer.commenceGoogle(config['remoteFolder'])
+    elapsed = time.perf_counter() - started
+
+    filesOK, bytesOK = piTransfer.ledger.execute('SELECT COUNT(*), SUM(size) FROM uploads').fetchone()
+    # A second pass over the now-uploaded tree shows what an everyday run costs, when there's little or nothing new:
+    rescanStarted = time.perf_counter()
+    piTransfer.imagesScanned = False # list_New_Images() only scans once per run
+    listNewImages(piTransfer.PI_PHOTO_DIR)
+    rescan = time.perf_counter() - rescanStarted
+    piTransfer.closeLedger()
+    bytesOK = bytesOK or 0
+    result = {
+        'files': config['numFiles'],
+        'filesOK': filesOK,
+        'MB': bytesOK / 2**20,
+        'seconds': elapsed,
+        'filesPerSec': filesOK / elapsed if elapsed else 0,
+        'MBPerSec': bytesOK / 2**20 / elapsed if elapsed else 0,
+        'peakRssMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'listNewImages': listTimes[0] if listTimes else None,
+        'rescan': rescan,
+        'status': piTransfer.lastStatus,
+    }
+    with open(config['resultFile'], 'w') as f:
+        json.dump(result, f)
+    return 0
+
+
+def printResult(result, header):
+    if header:
+        print(f"{'backend':8} {'files':>7} {'OK':>7} {'secs':>8} {'files/s':>8} {'MB/s':>7} {'RSS MB':>7} {'list s':>7} {'rescan':>7}  status")
+    listNewImages = f"{result['listNewImages']:7.2f}" if result['listNewImages'] is not None else '      -'
+    print(f"{result['backend']:8} {result['files']:7} {result['filesOK']:7} {result['seconds']:8.1f} {result['filesPerSec']:8.1f} "
+          f"{result['MBPerSec']:7.2f} {result['peakRssMB']:7.1f} {listNewImages} {result['rescan']:7.2f}  {result['status']}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())